@@ -6,6 +6,7 @@ from .subscriptionmanager import SubscriptionManager
 from .playbackmanager import PlaybackManager
 from os import environ, path
 from .config import Config
+from .metrics import metrics
 from argparse import ArgumentParser
 from importlib import import_module
 
@@ -37,10 +38,14 @@ def parse_config():
         level = environ.get('LOG_LEVEL')
         notify_interval = environ.get('NOTIFY_INTERVAL')
         gdm_interval = environ.get('GDM_INTERVAL')
+        pms_interval = environ.get('PMS_INTERVAL')
+        art_cache_path = environ.get('ART_CACHE_PATH')
+        art_cache_size = environ.get('ART_CACHE_SIZE')
         player_module = import_module('.player.' + player_name, package='plexmusicbridge')
         player_config = getattr(player_module, 'PlayerConfig')()
         player_config.parse_env()
-        config = Config(player_name, player_config, log, gdm, companion, title, subtitle, notify_interval, gdm_interval)
+        config = Config(player_name, player_config, log, gdm, companion, title, subtitle, notify_interval, gdm_interval,
+                        pms_interval, art_cache_path, art_cache_size)
     else:
         parser = ArgumentParser(description='PlexMusicBridge')
         parser.add_argument('-p', '--player_name', help='Player file name', required=True)
@@ -53,6 +58,9 @@ def parse_config():
         parser.add_argument('--notify_interval', help='Interval of sending play state notifications to all Plex '
                                                       'apps')
         parser.add_argument('--gdm_interval', help='Interval of sending GDM messages')
+        parser.add_argument('--pms_interval', help='Interval of sending unchanged play state to the Plex server')
+        parser.add_argument('--art_cache_path', help='Path to the album art cache')
+        parser.add_argument('--art_cache_size', help='Maximum size of the album art cache in MB')
         args = parser.parse_known_args()[0]
         player_module = import_module('.player.' + args.player_name, package='plexmusicbridge')
         player_config = getattr(player_module, 'PlayerConfig')()
@@ -61,7 +69,8 @@ def parse_config():
         player_config.save_arguments(args)
         level = args.log_level
         config = Config(args.player_name, player_config, args.log, args.gdm, args.companion, args.title, args.subtitle,
-                        args.notify_interval, args.gdm_interval)
+                        args.notify_interval, args.gdm_interval, args.pms_interval, args.art_cache_path,
+                        args.art_cache_size)
 
     if level == 'debug':
         level = logging.DEBUG
@@ -96,9 +105,13 @@ def main():
         pl.start()
 
         # run as long as player is ready
+        n = 0
         while pl.is_ready():
             from time import sleep
             sleep(2)
+            n += 1
+            if n % 30 == 0 and log.isEnabledFor(logging.DEBUG):
+                log.debug('Metrics:\n%s', metrics.summary())
 
         log.info('Player is offline -> restart')
         # shutdown
@@ -0,0 +1,175 @@
+import os
+from hashlib import sha1
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock, Event
+from time import monotonic
+from .metrics import metrics
+
+# number of tracks whose thumb can be looked up by rating key
+ART_KEYS = 512
+# seconds a renderer waits for a fetch of the same image that is already in flight
+FETCH_WAIT = 15
+
+
+class Fetch:
+    __slots__ = ('done', 'image')
+
+    def __init__(self):
+        self.done = Event()
+        # fetched image, handed to waiting requests even if it is not kept on disk
+        self.image = None
+
+
+class ArtCache:
+    """
+    Album art resized by the Plex photo transcoder, kept on disk and evicted least recently used first
+    """
+    def __init__(self, path, max_bytes, size):
+        self.log = getLogger('ArtCache')
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = size
+        self.lock = Lock()
+        # rating key -> (server, thumb) of recently played tracks
+        self.keys = OrderedDict()
+        # cache key -> file size, least recently used first
+        self.entries = OrderedDict()
+        self.total = 0
+        # cache key -> in flight fetch
+        self.pending = {}
+        self.load()
+
+    def load(self):
+        # rebuild the index from disk, the modification time is refreshed on every hit
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            if name.endswith('.tmp'):
+                os.remove(file_path)
+                continue
+            stat = os.stat(file_path)
+            files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.total += size
+        self.evict()
+        self.log.info('Loaded %d images (%d bytes)', len(self.entries), self.total)
+
+    def register(self, rating_key, server, thumb):
+        # remember where the art of a track comes from, returns False if the track has none
+        if not thumb:
+            return False
+        with self.lock:
+            self.keys[rating_key] = (server, thumb)
+            self.keys.move_to_end(rating_key)
+            while len(self.keys) > ART_KEYS:
+                self.keys.popitem(last=False)
+        return True
+
+    def cache_key(self, server, thumb):
+        ident = '{}|{}|{}'.format(server.machine_id, thumb, self.size)
+        return sha1(ident.encode()).hexdigest()
+
+    def get(self, rating_key):
+        # returns (cache key, image) or None if there is no art for the rating key
+        with self.lock:
+            source = self.keys.get(rating_key)
+        if source is None:
+            return None
+        server, thumb = source
+        key = self.cache_key(server, thumb)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    pending = None
+                else:
+                    pending = self.pending.get(key)
+                    if pending is None:
+                        # this request fetches the image, others wait for it
+                        fetch = self.pending[key] = Fetch()
+                        break
+            if pending is None:
+                image = self.read(key)
+                if image is not None:
+                    metrics.increment('art.hits')
+                    return key, image
+                continue
+            if not pending.done.wait(FETCH_WAIT) or pending.image is None:
+                return None
+            return key, pending.image
+        try:
+            fetch.image = self.fetch(server, thumb)
+            if fetch.image is None:
+                return None
+            self.store(key, fetch.image)
+            return key, fetch.image
+        finally:
+            with self.lock:
+                del self.pending[key]
+            fetch.done.set()
+
+    def read(self, key):
+        file_path = os.path.join(self.path, key)
+        try:
+            with open(file_path, 'rb') as f:
+                image = f.read()
+            os.utime(file_path)
+            return image
+        except OSError as e:
+            # file was removed behind our back
+            self.log.error('Could not read cached image %s: %s', key, e)
+            with self.lock:
+                size = self.entries.pop(key, None)
+                if size is not None:
+                    self.total -= size
+            return None
+
+    def fetch(self, server, thumb):
+        start = monotonic()
+        params = {'width': self.size, 'height': self.size, 'minSize': 1, 'upscale': 1, 'url': thumb}
+        try:
+            resp = server.request('/photo/:/transcode', params)
+            try:
+                if resp.status_code != 200:
+                    self.log.error('Could not fetch art %s: HTTP %s', thumb, resp.status_code)
+                    return None
+                image = resp.content
+            finally:
+                resp.close()
+        except Exception as e:
+            self.log.error('Could not fetch art %s: %s', thumb, e)
+            return None
+        metrics.record('art.fetch', monotonic() - start)
+        metrics.increment('art.misses')
+        return image
+
+    def store(self, key, image):
+        if len(image) > self.max_bytes:
+            self.log.warning('Image %s with %d bytes does not fit into the cache', key, len(image))
+            return
+        file_path = os.path.join(self.path, key)
+        try:
+            with open(file_path + '.tmp', 'wb') as f:
+                f.write(image)
+            os.replace(file_path + '.tmp', file_path)
+        except OSError as e:
+            self.log.error('Could not store image %s: %s', key, e)
+            return
+        with self.lock:
+            self.entries[key] = len(image)
+            self.total += len(image)
+            self.evict()
+
+    def evict(self):
+        # must be called with lock acquired (or before the cache is shared)
+        while self.total > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.remove(os.path.join(self.path, key))
+            except OSError as e:
+                self.log.error('Could not remove cached image %s: %s', key, e)
+            metrics.increment('art.evictions')
@@ -0,0 +1,112 @@
+from logging import getLogger
+from collections import deque
+from threading import Thread, Condition, Event, current_thread
+from time import monotonic
+from .metrics import metrics
+
+
+class Command:
+    __slots__ = ('path', 'opt', 'server', 'key', 'received', 'func', 'args', 'done')
+
+    def __init__(self, path, opt, server, key, func=None, args=()):
+        self.path = path
+        self.opt = opt
+        self.server = server
+        # commands with the same key supersede each other
+        self.key = key
+        self.received = monotonic()
+        # internal calls, e.g. end of track reported by the player
+        self.func = func
+        self.args = args
+        self.done = Event()
+
+    def name(self):
+        if self.func is not None:
+            return self.func.__name__
+        return self.path.rsplit('/', 1)[-1]
+
+
+class CommandExecutor:
+    """
+    Executes playback commands in order on a single thread, so requests can be acknowledged right away
+    """
+    def __init__(self, handler):
+        self.log = getLogger('CommandExecutor')
+        self.handler = handler
+        self.cond = Condition()
+        self.pending = deque()
+        # command that is executed right now
+        self.current = None
+        self.running = True
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, path, opt, server=None, key=None):
+        command = Command(path, opt, server, key)
+        with self.cond:
+            if key is not None:
+                # replace a pending command of the same kind if only other superseding commands follow it
+                for i in range(len(self.pending) - 1, -1, -1):
+                    queued = self.pending[i]
+                    if queued.key is None:
+                        break
+                    if queued.key == key:
+                        self.log.debug('Coalesce %s command', command.name())
+                        self.pending[i] = command
+                        queued.done.set()
+                        metrics.increment('command.coalesced')
+                        return
+            self.pending.append(command)
+            self.cond.notify()
+
+    def call(self, func, *args):
+        # run func on the executor thread and wait for it, so all state changes have a single writer
+        if current_thread() is self.thread:
+            func(*args)
+            return
+        command = Command(None, None, None, None, func, args)
+        with self.cond:
+            if not self.running:
+                return
+            self.pending.append(command)
+            self.cond.notify()
+        command.done.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                command = self.pending.popleft()
+                self.current = command
+            waited = monotonic() - command.received
+            try:
+                if command.func is not None:
+                    command.func(*command.args)
+                else:
+                    self.handler(command)
+            except Exception as e:
+                self.log.error('Error handling playback command %s: %s', command.name(), e)
+            finally:
+                self.current = None
+                command.done.set()
+            latency = monotonic() - command.received
+            metrics.record('command.' + command.name(), latency)
+            self.log.debug('Command %s took %.1f ms (%.1f ms queued)', command.name(), latency * 1000,
+                           waited * 1000)
+
+    def since_received(self):
+        # seconds since the running command was received, measured from now if there is none
+        current = self.current
+        return monotonic() - current.received if current is not None else 0.0
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            for command in self.pending:
+                command.done.set()
+            self.pending.clear()
+            self.cond.notify()
+        self.thread.join()
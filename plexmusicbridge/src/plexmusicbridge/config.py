@@ -1,6 +1,7 @@
 class Config:
     def __init__(self, player_name, player, log_path=None, gdm_port=None, companion_port=None, title=None, product=None,
-                 notify_interval=None, gdm_interval=None):
+                 notify_interval=None, gdm_interval=None, pms_interval=None, art_cache_path=None,
+                 art_cache_size=None):
         self.player = player
         self.gdm_port = gdm_port or 32412
         self.companion_port = companion_port or 32005
@@ -13,4 +14,8 @@ class Config:
         self.player_name = player_name or 'vlc'
         self.log_path = log_path or './'
         self.notify_interval = notify_interval or 0.5
-        self.gdm_interval = gdm_interval or 0.5
+        self.gdm_interval = float(gdm_interval or 30)
+        self.pms_interval = float(pms_interval or 10)
+        self.art_cache_path = art_cache_path or self.log_path + 'art/'
+        # megabytes
+        self.art_cache_size = float(art_cache_size or 50)
@@ -6,6 +6,10 @@ GDM_DATA = 'Content-Type: plex/media-player\r\nResource-Identifier: {}\r\nName:
            'Version: {}\r\nProtocol: plex\r\nProtocol-Version: 1\r\nProtocol-Capabilities: timeline,playback,' \
            'playqueues\r\nDevice-Class: STB\r\n'
 
+# Play queue window fetched on refresh and number of tracks around the current one that have to be loaded
+PQ_WINDOW = 50
+PQ_WINDOW_MARGIN = 10
+
 # Listener constants
 XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
 XML_OK = XML_HEADER + '<Response code="200" status="OK"/>'
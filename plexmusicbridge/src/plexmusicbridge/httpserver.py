@@ -2,14 +2,27 @@ from logging import getLogger
 from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 from urllib.parse import parse_qs, urlparse
 from .const import XML_OK, device_header, resource_xml, web_header
-from threading import Thread, Event
-import re
+from threading import Thread, Event, Lock
+import socket
+from .metrics import metrics
+
+# maximum time a long poll is parked until the timeline changes
+POLL_TIMEOUT = 9.5
+# idle time in seconds and number of requests after which a persistent connection is closed
+KEEP_ALIVE_TIMEOUT = 30
+KEEP_ALIVE_MAX = 1000
+# seconds renderers may reuse album art without asking again
+ART_MAX_AGE = 86400
 
 
 class RequestHandler(SimpleHTTPRequestHandler):
+    # socket timeout, closes idle persistent connections
+    timeout = KEEP_ALIVE_TIMEOUT
+
     def __init__(self, *args, **kwargs):
         self.protocol_version = 'HTTP/1.1'
         self.log = getLogger('HTTPServer')
+        self.requests_served = 0
         SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
 
     def log_message(self, fmt, *args):
@@ -21,15 +34,26 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
     def send_resp(self, body, headers=None, code=200):
         headers = {} if headers is None else headers
+        if isinstance(body, str):
+            body = body.encode('utf-8')
         try:
             self.send_response(code)
             for key in headers:
                 self.send_header(key, headers[key])
             self.send_header('Content-Length', str(len(body)))
-            self.send_header('Connection', 'close')
+            self.requests_served += 1
+            if self.requests_served >= KEEP_ALIVE_MAX or self.server.stopped.is_set():
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            else:
+                self.send_header('Connection', 'keep-alive')
+                self.send_header('Keep-Alive', 'timeout={}, max={}'.format(KEEP_ALIVE_TIMEOUT,
+                                                                           KEEP_ALIVE_MAX - self.requests_served))
             self.end_headers()
-            self.wfile.write(body.encode('utf-8'))
+            self.wfile.write(body)
         except Exception as e:
+            self.close_connection = True
             self.log.error(e)
 
     def parse_path(self):
@@ -44,6 +68,11 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
     def handle_request(self):
         # handle get requests
+        if self.server.stopped.is_set():
+            # managers of a stopped server must not be used anymore
+            self.close_connection = True
+            self.send_resp('', code=503)
+            return
         request_path, request_params = self.parse_path()
         self.log.info('Request path: ' + request_path)
         self.log.debug('Request parameters: ' + str(request_params))
@@ -64,6 +93,9 @@ class RequestHandler(SimpleHTTPRequestHandler):
         elif request_path == '/resources':
             self.send_resp(resource_xml(self.server.config), device_header(self.server.config))
 
+        elif request_path.startswith('/art/'):
+            self.handle_art(request_path[len('/art/'):])
+
         elif request_path == '/player/timeline/poll':
             self.handle_polling(request_params)
 
@@ -92,8 +124,24 @@ class RequestHandler(SimpleHTTPRequestHandler):
             else:
                 self.send_resp('', device_header(self.server.config))
 
+    def handle_art(self, rating_key):
+        with metrics.timer('http.art'):
+            art = self.server.play_mgr.get_art(rating_key)
+        if art is None:
+            self.send_resp('', code=404)
+            return
+        etag, image = art
+        headers = {
+            'Cache-Control': 'public, max-age={}'.format(ART_MAX_AGE),
+            'ETag': '"{}"'.format(etag)
+        }
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            self.send_resp('', headers, code=304)
+        else:
+            headers['Content-Type'] = 'image/jpeg'
+            self.send_resp(image, headers)
+
     def handle_polling(self, request_params):
-        from time import sleep, monotonic
         sub_mgr = self.server.sub_mgr
         wait_for_update = request_params.get('wait') == '1'
         # Use request origin as stable key for poll/command ordering; some clients vary identifier headers.
@@ -109,17 +157,19 @@ class RequestHandler(SimpleHTTPRequestHandler):
 
         # Plexamp expects long-poll style behavior for wait=1.
         if wait_for_update and timeline_id <= last_timeline_id:
-            timeout_s = 9.5
-            start = monotonic()
-            while self.server.play_mgr.get_timeline_id() <= last_timeline_id:
-                if monotonic() - start >= timeout_s:
-                    self.send_resp('', web_header(self.server.config))
-                    self.log.debug('No timeline change for wait poll, return empty response')
-                    return
-                sleep(0.25)
+            timeline_id = self.server.play_mgr.wait_for_timeline(last_timeline_id, POLL_TIMEOUT)
+            if self.server.stopped.is_set():
+                self.close_connection = True
+                return
+            if timeline_id <= last_timeline_id:
+                self.send_resp('', web_header(self.server.config))
+                self.log.debug('No timeline change for wait poll, return empty response')
+                return
 
         response_command_id = self.server.latest_command_id.get(client_key, request_command_id)
-        msg = sub_mgr.msg().format(command_id=response_command_id)
+        with metrics.timer('http.poll'):
+            timeline = sub_mgr.msg()
+            msg = timeline.render(response_command_id)
         # Build message first; state getters may bump timeline id (e.g. external volume changes).
         timeline_id = self.server.play_mgr.get_timeline_id()
         changed = timeline_id > last_timeline_id
@@ -127,11 +177,9 @@ class RequestHandler(SimpleHTTPRequestHandler):
         if changed or (sub_mgr.is_playing and not wait_for_update):
             self.send_resp(msg, web_header(self.server.config))
             self.server.timeline_tracker[client_key] = timeline_id
-            if self.log.isEnabledFor(10):
-                volume = re.search(r'volume="([^"]+)"', msg)
-                self.log.debug('Timeline response cmd=%s changed=%s wait=%s volume=%s',
-                               response_command_id, changed, wait_for_update,
-                               volume.group(1) if volume else 'n/a')
+            self.log.debug('Timeline response cmd=%s changed=%s wait=%s volume=%s',
+                           response_command_id, changed, wait_for_update,
+                           timeline.volume if timeline.volume is not None else 'n/a')
             self.log.debug('Send current state to Plex web clients')
         elif not sub_mgr.stop_send_to_web:
             sub_mgr.stop_send_to_web = True
@@ -152,11 +200,34 @@ class HTTPServer(ThreadingHTTPServer):
         self.timeline_tracker = {}
         self.latest_command_id = {}
         self.stopped = Event()
+        # sockets of connected clients, closed on stop so kept alive connections do not outlive the server
+        self.connections_lock = Lock()
+        self.connections = set()
         ThreadingHTTPServer.__init__(self, ('0.0.0.0', config.companion_port), RequestHandler)
         self.server_thread = Thread(target=self.serve_forever, args=(0.5,), daemon=True)
         self.server_thread.start()
 
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        ThreadingHTTPServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        ThreadingHTTPServer.shutdown_request(self, request)
+
     def stop(self):
+        self.stopped.set()
         self.shutdown()
         self.server_thread.join()
         self.socket.close()
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        # wake up long polls, they answer and close their connection
+        self.play_mgr.bump_timeline_id()
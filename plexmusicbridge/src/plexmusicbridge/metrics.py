@@ -0,0 +1,63 @@
+from threading import Lock
+from time import monotonic
+from contextlib import contextmanager
+
+
+class Latency:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __str__(self):
+        return 'n={} avg={:.1f}ms max={:.1f}ms last={:.1f}ms'.format(self.count, self.mean() * 1000,
+                                                                     self.max * 1000, self.last * 1000)
+
+
+class Metrics:
+    """
+    Process wide latency and counter registry, summarized in the debug log
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.latencies = {}
+        self.counters = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            latency = self.latencies.get(name)
+            if latency is None:
+                latency = self.latencies[name] = Latency()
+            latency.record(seconds)
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, monotonic() - start)
+
+    def summary(self):
+        with self.lock:
+            lines = [name + ': ' + str(latency) for name, latency in sorted(self.latencies.items())]
+            lines += [name + ': ' + str(value) for name, value in sorted(self.counters.items())]
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
@@ -1,8 +1,47 @@
 from logging import getLogger
-from .plexserver import PlexServer
+from .plexserver import PlexServer, PlexServerRegistry
 from importlib import import_module
-from .playqueue import PlayQueue
-from threading import Lock
+from .playqueue import PlayQueue, Track
+from .playerstate import PlayerStateCache
+from .const import PQ_WINDOW, PQ_WINDOW_MARGIN
+from .metrics import metrics
+from .commandexecutor import CommandExecutor
+from .artcache import ArtCache
+from threading import Lock, Thread, Event, Condition
+from time import monotonic
+
+# parameters a command cannot be executed without
+REQUIRED_PARAMS = {
+    '/player/playback/playMedia': ('type', 'containerKey'),
+    '/player/playback/refreshPlayQueue': ('playQueueID',),
+    '/player/playback/seekTo': ('offset',),
+    '/player/playback/skipTo': ('key',)
+}
+
+
+class PlaybackState:
+    """
+    Immutable snapshot of what is playing, replaced as a whole so readers never wait for a state change
+    """
+    __slots__ = ('state', 'track', 'shuffle', 'repeat', 'server', 'token')
+
+    def __init__(self, state='stopped', track=None, shuffle=0, repeat=0, server=None, token=None):
+        self.state = state
+        # track info of the current play queue item, None if the play queue is empty
+        self.track = track
+        self.shuffle = shuffle
+        self.repeat = repeat
+        self.server = server or {}
+        self.token = token
+
+
+class QueueLoad:
+    __slots__ = ('ready', 'started')
+
+    def __init__(self):
+        self.ready = Event()
+        # set together with ready if a new play queue was begun and its selected track was loaded
+        self.started = False
 
 
 class PlaybackManager:
@@ -15,103 +54,118 @@ class PlaybackManager:
         # play queue
         self.queue_lock = Lock()
         self.queue = PlayQueue()
-        # plex server
+        # plex servers by machine identifier, plex_server owns the active play queue
         self.plex_lock = Lock()
+        self.plex_servers = PlexServerRegistry()
         self.plex_server = PlexServer()
         # player
         self.player_lock = Lock()
         player_module = import_module('.player.' + config.player_name, package='plexmusicbridge')
         self.player = getattr(player_module, 'Player')(self, config)
+        self.player_state = PlayerStateCache(self.player, self.player_lock)
+        # track handed to the player with preload_next and not started yet
+        self.preloaded = None
+        # resized album art served by the companion server, drivers without art size or host ip send the thumb url
+        self.art_cache = None
+        self.art_host = getattr(config.player, 'host_ip', None)
+        art_size = getattr(config.player, 'art_size', None)
+        if art_size and self.art_host:
+            self.art_cache = ArtCache(config.art_cache_path, int(config.art_cache_size * 1024 * 1024), art_size)
         # variables
         self.lock = Lock()
+        # long polls wait on this for the next timeline id
+        self.timeline_changed = Condition(self.lock)
         self.is_playing = False
         self.is_paused = False
+        # the current track did not start, play loads it again instead of resuming
+        self.start_failed = False
         self.last_cmd_id = {}
         self.timeline_id = 1
+        # published snapshot, writers serialize on publish_lock while capturing it
+        self.publish_lock = Lock()
+        self.state = PlaybackState()
+        self.commands = CommandExecutor(self.execute_cmd)
 
     def start(self):
         with self.player_lock:
             self.player.start()
 
     def get_play_state(self):
-        with self.lock:
-            return self.is_playing
+        return self.state.state != 'stopped'
+
+    def get_state(self):
+        return self.state.state
+
+    def get_elapsed(self):
+        return self.player_state.get_elapsed() if self.get_play_state() else 0
+
+    def get_duration(self):
+        track = self.state.track
+        return int(track['duration'] or 0) if track else 0
 
     def get_state_dct(self):
-        self.lock.acquire()
-        if self.is_playing:
-            self.lock.release()
-            with self.queue_lock:
-                track_info = self.queue.get_track_info()
-                shuffle = self.queue.get_shuffle()
-                repeat = self.queue.get_repeat()
-            with self.plex_lock:
-                server_info = self.plex_server.get_info()
-            with self.player_lock:
-                elapsed = self.player.get_elapsed()
-                volume = self.player.get_volume()
-                muted = int(self.player.is_muted())
-            state = {
-                'time': elapsed,
-                'volume': volume,
-                'mute': muted,
-                'state': self.get_state(),
-                'shuffle': shuffle,
-                'repeat': repeat
-            }
-            state.update(track_info)
-            state.update(server_info)
-            return state
-        else:
-            self.lock.release()
+        snapshot = self.state
+        if snapshot.state == 'stopped' or snapshot.track is None:
             return None
+        state = {
+            'time': self.player_state.get_elapsed(),
+            'mute': int(self.player_state.is_muted()),
+            'state': snapshot.state,
+            'shuffle': snapshot.shuffle,
+            'repeat': snapshot.repeat
+        }
+        volume = self.player_state.get_volume()
+        if volume is not None:
+            state['volume'] = volume
+        state.update(snapshot.track)
+        state.update(snapshot.server)
+        return state
 
     def get_pms_state(self):
-        self.queue_lock.acquire()
-        if not self.queue.is_empty():
-            rating_key = self.queue.get_rating_key()
-            key = self.queue.get_key()
-            duration = self.queue.get_duration()
-            pq_item_id = self.queue.get_pq_item_id()
-            shuffle = self.queue.get_shuffle()
-            repeat = self.queue.get_repeat()
-            container_key = '/playQueues/' + self.queue.get_pq_id()
-            self.queue_lock.release()
-            if self.is_playing:
-                with self.player_lock:
-                    elapsed = self.player.get_elapsed()
-            else:
-                elapsed = 0
+        snapshot = self.state
+        if snapshot.track is None:
+            return None
+        track = snapshot.track
+        return {
+            'state': snapshot.state,
+            'ratingKey': track['ratingKey'],
+            'key': track['key'],
+            'time': self.player_state.get_elapsed() if snapshot.state != 'stopped' else 0,
+            'duration': track['duration'],
+            'playQueueItemID': track['playQueueItemID'],
+            'X-Plex-Token': snapshot.token,
+            'shuffle': snapshot.shuffle,
+            'repeat': snapshot.repeat,
+            'containerKey': track['containerKey']
+        }
+
+    def publish(self):
+        # capture queue and server state from memory and swap in a new snapshot, never holds a lock across I/O
+        with self.publish_lock:
+            with self.queue_lock:
+                # no current track right after a reset, while a queue is streamed or if a refresh removed it
+                track = None if self.queue.is_empty() else self.queue.get_track_info()
+                shuffle = self.queue.get_shuffle()
+                repeat = self.queue.get_repeat()
             with self.plex_lock:
+                server = self.plex_server.get_info()
                 token = self.plex_server.token
-            return {
-                'state': self.get_state(),
-                'ratingKey': rating_key,
-                'key': key,
-                'time': elapsed,
-                'duration': duration,
-                'playQueueItemID': pq_item_id,
-                'X-Plex-Token': token,
-                'shuffle': shuffle,
-                'repeat': repeat,
-                'containerKey': container_key
-            }
-        else:
-            self.queue_lock.release()
-            return None
+            with self.lock:
+                if self.is_playing and self.is_paused:
+                    state = 'paused'
+                elif self.is_playing:
+                    state = 'playing'
+                else:
+                    state = 'stopped'
+                self.state = PlaybackState(state, track, shuffle, repeat, server, token)
+                self.next_timeline_id()
 
-    def get_current_pms_timeline(self):
+    def get_server(self):
         with self.plex_lock:
-            return self.plex_server.build_url('/:/timeline', False)
+            return self.plex_server
 
-    def get_state(self):
-        with self.lock:
-            if self.is_playing and self.is_paused:
-                return 'paused'
-            elif self.is_playing and not self.is_paused:
-                return 'playing'
-            else:
-                return 'stopped'
+    def send_pms_timeline(self, params):
+        self.get_server().send_timeline(params)
 
     def get_timeline_id(self):
         with self.lock:
@@ -119,12 +173,30 @@ class PlaybackManager:
 
     def bump_timeline_id(self):
         with self.lock:
-            self.timeline_id += 1
+            self.next_timeline_id()
+
+    def next_timeline_id(self):
+        # must be called with lock acquired
+        self.timeline_id += 1
+        self.timeline_changed.notify_all()
+
+    def wait_for_timeline(self, timeline_id, timeout):
+        # block until the timeline id is newer than the given one, returns the current id
+        with self.lock:
+            self.timeline_changed.wait_for(lambda: self.timeline_id > timeline_id, timeout)
+            return self.timeline_id
+
+    def player_state_changed(self):
+        # called by players if volume or mute changed on the device
+        self.player_state.invalidate_volume()
+        self.bump_timeline_id()
 
     def handle_cmd(self, address, path, opt):
-        # try to update server info
+        self.validate_cmd(path, opt)
+
+        # try to update server info of the server the command belongs to
         with self.plex_lock:
-            self.plex_server.update(opt)
+            server = self.plex_servers.update(opt)
 
         # check if we receive a command twice by comparing host and last command id
         with self.lock:
@@ -136,14 +208,35 @@ class PlaybackManager:
                 pass
             self.last_cmd_id[address[0]] = opt['commandID']
 
+        # acknowledge right away, the executor runs commands in order
+        self.commands.submit(path, opt, server, self.coalesce_key(path, opt))
+
+    @staticmethod
+    def validate_cmd(path, opt):
+        missing = [param for param in REQUIRED_PARAMS.get(path, ()) if param not in opt]
+        if missing:
+            raise ValueError('Missing parameters for {}: {}'.format(path, ', '.join(missing)))
+
+    @staticmethod
+    def coalesce_key(path, opt):
+        # only the latest seek or volume target of a slider drag has to reach the player
+        if path == '/player/playback/seekTo':
+            return 'seek'
+        if path == '/player/playback/setParameters' and opt.get('volume') and not opt.get('repeat'):
+            return 'volume'
+        return None
+
+    def execute_cmd(self, command):
+        path, opt, server = command.path, command.opt, command.server
         if path == '/player/playback/playMedia':
-            self.play_media(opt['type'], opt['containerKey'])
+            self.play_media(opt['type'], opt['containerKey'], server)
         elif path == '/player/playback/refreshPlayQueue':
-            self.update_queue('/playQueues/' + opt['playQueueID'])
+            self.update_queue('/playQueues/' + opt['playQueueID'], server)
         elif path == '/player/playback/seekTo':
             with self.player_lock:
                 self.player.seek(int(opt['offset']))
-            self.bump_timeline_id()
+            self.player_state.seeked(int(opt['offset']))
+            self.publish()
         elif path == '/player/playback/pause':
             self.pause()
         elif path == '/player/playback/play':
@@ -165,124 +258,304 @@ class PlaybackManager:
             if opt.get('repeat'):
                 with self.queue_lock:
                     self.queue.set_repeat(int(opt['repeat']))
-                self.bump_timeline_id()
+                self.publish()
+                self.preload_next()
             elif opt.get('volume'):
                 with self.player_lock:
                     self.player.set_volume(int(opt['volume']))
-                self.bump_timeline_id()
+                self.player_state.volume_set(int(opt['volume']))
+                self.publish()
             elif opt.get('shuffle'):
+                if int(opt['shuffle']):
+                    # shuffling needs all tracks of a windowed queue
+                    self.load_queue()
                 with self.queue_lock:
                     self.queue.set_shuffle(int(opt['shuffle']))
-                self.bump_timeline_id()
+                self.publish()
+                self.preload_next()
             else:
-                self.log.warning('Not implemented: ' + opt)
+                self.log.warning('Not implemented: ' + str(opt))
         else:
             self.log.warning('Not implemented: ' + path)
 
-    def update_queue(self, container_key):
+    def select_server(self, server, owner):
+        # switch to the server of a command if it owns the play queue or no server is known yet
         with self.plex_lock:
-            pq = self.plex_server.get_queue(container_key)
+            if server is not None and server is not self.plex_server and (owner or not self.plex_server.address):
+                self.log.info('Play queue owned by Plex server %s', server.machine_id or server.address)
+                self.plex_server = server
+
+    def update_queue(self, container_key, server=None):
+        self.select_server(server, False)
+        plex_server = self.get_server()
         with self.queue_lock:
-            self.queue.update(pq, True)
-        self.bump_timeline_id()
+            center = None if self.queue.get_shuffle() else self.queue.get_current_item_id()
+        merged = False
+        if center:
+            pq = plex_server.get_queue(container_key, PQ_WINDOW, center)
+            with self.queue_lock:
+                merged = self.queue.merge_window(pq)
+        if not merged:
+            self.log.debug('Refresh whole play queue')
+            pq = plex_server.get_queue(container_key)
+            with self.queue_lock:
+                self.queue.update(pq)
+        self.publish()
+        self.preload_next()
+
+    def load_queue(self):
+        # replace a windowed queue by the whole queue
+        with self.queue_lock:
+            if not self.queue.get_pq_id() or self.queue.is_complete():
+                return
+            container_key = '/playQueues/' + self.queue.get_pq_id()
+        self.log.debug('Load whole play queue')
+        pq = self.get_server().get_queue(container_key)
+        with self.queue_lock:
+            self.queue.fill(pq)
+
+    def load_window(self):
+        # lazily fetch the tracks around the current one if they are not loaded yet
+        with self.queue_lock:
+            if self.queue.is_empty() or not self.queue.needs_window(PQ_WINDOW_MARGIN):
+                return
+            container_key = '/playQueues/' + self.queue.get_pq_id()
+            center = self.queue.get_current_item_id()
+        self.log.debug('Load play queue window around item %s', center)
+        pq = self.get_server().get_queue(container_key, PQ_WINDOW, center)
+        with self.queue_lock:
+            merged = self.queue.merge_window(pq)
+        if not merged:
+            self.load_queue()
 
-    def play_media(self, media_type, container_key):
+    def play_media(self, media_type, container_key, server=None):
         if media_type != 'music':
             self.log.error('Items in the queue are not of type music')
             self.stop()
         else:
-            with self.plex_lock:
-                pq = self.plex_server.get_queue(container_key)
-            with self.queue_lock:
-                self.queue.reset()
-                self.queue.update(pq, False)
+            start = monotonic()
+            self.select_server(server, True)
+            try:
+                items = self.get_server().stream_queue(container_key)
+            except Exception as e:
+                self.log.error('Could not load play queue: ' + str(e))
+                self.stop_playback(True)
+                return
+            # start playback as soon as the selected track is parsed, the rest is loaded in the background
+            load = QueueLoad()
+            Thread(target=self.ingest_queue, args=(items, load), daemon=True).start()
+            load.ready.wait()
+            if not load.started:
+                self.log.error('Selected track of play queue %s could not be loaded, stop playback', container_key)
+                self.stop_playback(True)
+                return
             self.play()
+            elapsed = monotonic() - start
+            with self.queue_lock:
+                length = self.queue.get_length()
+            metrics.record('playqueue.first_audio.' + self.size_bucket(length), elapsed)
+            self.log.info('Time to first audio: %.0f ms (%s tracks)', elapsed * 1000, length)
+
+    def ingest_queue(self, items, load):
+        generation = None
+        try:
+            for tag, item in items:
+                if tag == 'MediaContainer':
+                    with self.queue_lock:
+                        self.queue.reset()
+                        generation = self.queue.begin(item)
+                else:
+                    track = Track.from_element(item)
+                    with self.queue_lock:
+                        if generation is None or not self.queue.add_track(generation, track):
+                            self.log.info('Play queue replaced while loading, stop loading')
+                            break
+                        if not load.ready.is_set() and self.queue.is_loaded():
+                            load.started = True
+                            load.ready.set()
+        except Exception as e:
+            self.log.error('Could not load play queue: ' + str(e))
+        finally:
+            items.close()
+            if generation is not None:
+                with self.queue_lock:
+                    self.queue.finish(generation)
+            load.ready.set()
+
+    @staticmethod
+    def size_bucket(length):
+        for bucket in (10, 100, 1000, 10000):
+            if length <= bucket:
+                return 'le' + str(bucket)
+        return 'gt10000'
+
+    def build_urls(self, track, thumb, rating_key):
+        plex_server = self.get_server()
+        track_url = plex_server.build_url(track,
+                                          rewrite_http=self.config.player.rewrite_http,
+                                          rewrite_host=self.config.player.rewrite_host)
+        if self.art_cache is not None and self.art_cache.register(rating_key, plex_server, thumb):
+            thumb_url = 'http://{}:{}/art/{}'.format(self.art_host, self.config.companion_port, rating_key)
+            return track_url, thumb_url
+        thumb_url = plex_server.build_url(thumb,
+                                          rewrite_http=self.config.player.rewrite_http,
+                                          rewrite_host=self.config.player.rewrite_host)
+        return track_url, thumb_url
 
     def load_play(self):
+        with self.queue_lock:
+            loaded = self.queue.is_loaded()
+        if not loaded:
+            self.load_queue()
         with self.queue_lock:
             track = self.queue.get_track()
             thumb = self.queue.get_thumb()
-        with self.plex_lock:
-            track_url = self.plex_server.build_url(track,
-                                                   rewrite_http=self.config.player.rewrite_http,
-                                                   rewrite_host=self.config.player.rewrite_host)
-            thumb_url = self.plex_server.build_url(thumb,
-                                                   rewrite_http=self.config.player.rewrite_http,
-                                                   rewrite_host=self.config.player.rewrite_host)
+            rating_key = self.queue.get_rating_key()
+        track_url, thumb_url = self.build_urls(track, thumb, rating_key)
+        with self.player_lock:
+            started = self.player.play(track_url, thumb_url)
+            self.preloaded = None
+        with self.lock:
+            self.start_failed = started is False
+            if self.start_failed:
+                self.is_paused = True
+        if started is False:
+            # keep the session, clients show the track paused and can start it again
+            self.log.error('Player did not start playback, pause on the current track')
+            metrics.increment('playback.start_failures')
+            self.player_state.stopped()
+            self.publish()
+            return
+        time_to_audio = self.commands.since_received()
+        metrics.record('playback.time_to_audio', time_to_audio)
+        self.log.info('Time to audio: %.0f ms', time_to_audio * 1000)
+        self.player_state.started()
+        self.publish()
+        self.load_window()
+        self.preload_next()
+
+    def preload_next(self):
+        # hand the next track to the player so it can start it without a gap, take it back if the next track changed
+        preload = getattr(self.player, 'preload_next', None)
+        if preload is None or not self.get_play_state():
+            return
+        track = None
+        with self.queue_lock:
+            pos = None
+            if not self.queue.is_empty() and self.queue.position is not None:
+                pos = self.queue.peek_next_pos()
+            # repeating a single track is left to auto_next
+            if pos is not None and pos != self.queue.position and self.queue.is_loaded(pos):
+                track = self.queue.get_url(pos)
+                thumb = self.queue.get_thumb(pos)
+                rating_key = self.queue.get_rating_key(pos)
+        with self.player_lock:
+            if track == self.preloaded:
+                return
+        if track is not None:
+            track_url, thumb_url = self.build_urls(track, thumb, rating_key)
+            with self.player_lock:
+                if preload(track_url, thumb_url):
+                    self.log.debug('Preloaded next track: ' + track)
+                    self.preloaded = track
+                    return
+        # the player must not start the formerly preloaded track at the end of the current one
+        clear = getattr(self.player, 'clear_next', None)
+        with self.player_lock:
+            if self.preloaded is not None and clear is not None and clear():
+                self.log.debug('Cleared preloaded track: ' + self.preloaded)
+                self.preloaded = None
+
+    def preloaded_started(self):
+        # the player moved on to the preloaded track by itself
+        self.commands.call(self.advance_preloaded)
+
+    def advance_preloaded(self):
         with self.player_lock:
-            self.player.play(track_url, thumb_url)
+            preloaded, self.preloaded = self.preloaded, None
+        with self.queue_lock:
+            track = None
+            if self.queue.position is not None and self.queue.next_pos(True):
+                track = self.queue.get_track()
+        if track is None:
+            # the queue ended or lost its current item after the track was handed to the player
+            self.log.warning('Player started a track after the end of the play queue, stop playback')
+            self.stop_playback(True)
+            return
+        if track != preloaded:
+            self.log.warning('Player started another track than the next one in the play queue, play it instead')
+            self.load_play()
+            return
+        self.player_state.started()
+        self.publish()
+        self.load_window()
+        self.preload_next()
 
     def play(self):
-        self.lock.acquire()
-        if self.is_paused and self.is_playing:
+        with self.lock:
+            resume = self.is_paused and self.is_playing and not self.start_failed
             self.is_playing = True
             self.is_paused = False
-            self.timeline_id += 1
-            self.lock.release()
+        if not resume:
+            # the time of the previous track must not be reported for the new one during the handshake
+            self.player_state.loading()
+        self.publish()
+        if resume:
             with self.player_lock:
                 self.player.resume()
-        elif self.is_playing and not self.is_paused:
-            self.is_playing = True
-            self.is_paused = False
-            self.timeline_id += 1
-            self.lock.release()
-            self.load_play()
-        elif not self.is_playing:
-            self.is_playing = True
-            self.is_paused = False
-            self.timeline_id += 1
-            self.lock.release()
+            self.player_state.resumed()
+        else:
             self.load_play()
 
     def pause(self):
-        self.lock.acquire()
-        if not self.is_paused:
+        with self.lock:
+            if self.is_paused:
+                return
             self.is_paused = True
-            self.timeline_id += 1
-            self.lock.release()
-            with self.player_lock:
-                self.player.pause()
-        else:
-            self.lock.release()
+        self.publish()
+        with self.player_lock:
+            self.player.pause()
+        self.player_state.paused()
 
     def skip(self, key):
+        with self.queue_lock:
+            found = self.queue.contains(key)
+        if not found:
+            self.load_queue()
         with self.queue_lock:
             self.queue.set_pos(key)
         self.play()
 
     def stop(self):
-        with self.lock:
-            was_active = self.is_playing or self.is_paused
-            self.is_playing = False
-            self.is_paused = False
-            if was_active:
-                self.timeline_id += 1
-        with self.queue_lock:
-            self.queue.reset()
-        with self.player_lock:
-            self.player.stop()
+        self.commands.call(self.stop_playback, True)
 
     def stop_local(self):
+        # playback was stopped on the device, e.g. by another source
+        self.commands.call(self.stop_playback, False)
+
+    def stop_playback(self, stop_player):
         with self.lock:
-            was_active = self.is_playing or self.is_paused
             self.is_playing = False
             self.is_paused = False
-            if was_active:
-                self.timeline_id += 1
         with self.queue_lock:
             self.queue.reset()
+        self.publish()
+        if stop_player:
+            with self.player_lock:
+                self.player.stop()
+                self.preloaded = None
+        self.player_state.stopped()
 
     def auto_next(self):
-        with self.queue_lock:
-            ret = self.queue.next_pos(True)
-        if ret:
-            self.play()
-        else:
-            self.stop()
+        # end of track reported by the player monitor
+        self.commands.call(self.advance, True)
 
     def next(self):
+        self.advance(False)
+
+    def advance(self, auto):
         with self.queue_lock:
-            ret = self.queue.next_pos(False)
+            ret = self.queue.next_pos(auto)
         if ret:
             self.play()
         else:
@@ -294,13 +567,22 @@ class PlaybackManager:
         self.play()
 
     def kill(self):
+        self.commands.stop()
         with self.player_lock:
             self.player.kill()
+        with self.plex_lock:
+            self.plex_server.close()
+            self.plex_servers.close()
+
+    def get_art(self, rating_key):
+        # returns (etag, image) of a track played by the bridge or None
+        if self.art_cache is None:
+            return None
+        return self.art_cache.get(rating_key)
 
     def is_ready(self):
-        with self.player_lock:
-            return self.player.is_ready()
+        # stateless reachability check, may take a network round trip
+        return self.player.is_ready()
 
     def wait_for_ready(self):
-        with self.player_lock:
-            return self.player.wait_for_ready()
+        return self.player.wait_for_ready()
@@ -4,6 +4,8 @@ from logging import getLogger
 
 class PlayerConfig:
     def __init__(self):
+        # size of the album art served by the bridge (also needs host_ip), None to pass the Plex thumb url
+        self.art_size = None
         self.rewrite_http = False
         self.rewrite_host = False
 
@@ -30,8 +32,18 @@ class Player:
         pass
 
     def play(self, track_url, thumb_url):
-        # play file
-        pass
+        # play file and wait until playback started, return False if it did not start in time
+        return True
+
+    def preload_next(self, track_url, thumb_url):
+        # optional: queue the next file for gapless playback and call manager.preloaded_started() once it plays,
+        # return False if not supported
+        return False
+
+    def clear_next(self):
+        # optional with preload_next: drop the preloaded file so playback ends after the current one,
+        # return False if it could not be dropped
+        return True
 
     def stop(self):
         # stop playback
@@ -0,0 +1,726 @@
+import re
+from http.client import HTTPConnection, HTTPException
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger
+from threading import Lock, Thread, Event, Condition
+from time import monotonic, sleep
+from urllib.parse import urlparse
+from urllib.request import urlopen
+from xml.sax.saxutils import unescape
+from xml.etree import ElementTree
+from ..metrics import metrics
+
+ENVELOPE_START = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope ' \
+                 b'xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
+                 b's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'
+ENVELOPE_END = b'</s:Body></s:Envelope>'
+AV_URN = 'urn:schemas-upnp-org:service:AVTransport:1'
+REND_URN = 'urn:schemas-upnp-org:service:RenderingControl:1'
+TIMEOUT = 5
+# requested subscription lifetime, renewal ahead of the negotiated one and resubscribe backoff in seconds
+SUBSCRIBE_TIMEOUT = 3600
+RENEW_BEFORE = 60
+BACKOFF_MIN = 2
+BACKOFF_MAX = 300
+# seconds an evented track position is used before asking the device again
+POSITION_MAX_AGE = 10
+# notifications wake up the monitor, it only polls as a safety net every MONITOR_INTERVAL seconds
+MONITOR_INTERVAL = 5
+# seconds a stopped device may take to start the preloaded track on its own
+ADVANCE_GRACE = 1.5
+
+# hack to set the correct thumbnail
+# rest of metadata is not used by device but necessary to send
+META_DATA_FMT = '&lt;DIDL-Lite xmlns=&quot;urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/&quot; ' \
+                'xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot; ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot; ' \
+                'xmlns:dlna=&quot;urn:schemas-dlna-org:metadata-1-0/&quot;&gt;&lt;item id=&quot;23$45076$@45077&quot; '\
+                'parentID=&quot;23$45076&quot; restricted=&quot;1&quot;&gt;&lt;dc:title ' \
+                'xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot;&gt;Keeping The ' \
+                'Faith&lt;/dc:title&gt;&lt;upnp:class ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;object.item.audioItem.musicTrack' \
+                '&lt;/upnp:class&gt;&lt;dc:date ' \
+                'xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot;&gt;1991-01-01&lt;/dc:date&gt;&lt;upnp:album ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;1991&lt;/upnp:album&gt;&lt;upnp' \
+                ':artist xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;Lynyrd ' \
+                'Skynyrd&lt;/upnp:artist&gt;&lt;dc:creator ' \
+                'xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot;&gt;Lynyrd ' \
+                'Skynyrd&lt;/dc:creator&gt;&lt;upnp:genre ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;Southern ' \
+                'Rock&lt;/upnp:genre&gt;&lt;upnp:originalTrackNumber ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;2&lt;/upnp:originalTrackNumber&gt' \
+                ';&lt;upnp:albumArtURI xmlns:dlna=&quot;urn:schemas-dlna-org:metadata-1-0/&quot; ' \
+                'dlna:profileID=&quot;JPEG_TN&quot; ' \
+                'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;{}&lt;/upnp:albumArtURI&gt;&lt;res '\
+                'bitrate=&quot;112875&quot; duration=&quot;0:05:19.000&quot; nrAudioChannels=&quot;2&quot; ' \
+                'protocolInfo=&quot;http-get:*:audio/x-flac:*&quot; sampleFrequency=&quot;44100&quot; ' \
+                'size=&quot;36126766&quot;&gt;http://192.168.10.2:50002/m/NDLNA/45077.flac&lt;/res&gt;&lt;/item&gt' \
+                ';&lt;/DIDL-Lite&gt; '
+
+
+META_DATA_PREFIX, META_DATA_SUFFIX = (part.encode() for part in META_DATA_FMT.split('{}'))
+FAULT_RE = re.compile(rb'<(?:[\w-]+:)?errorDescription>(.*?)</(?:[\w-]+:)?errorDescription>', re.S)
+
+
+def meta_data(thumb_url):
+    return META_DATA_PREFIX + thumb_url.encode() + META_DATA_SUFFIX
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_time(value):
+    # H:MM:SS with optional fraction to ms, None for NOT_IMPLEMENTED and the like
+    try:
+        hours, minutes, seconds = value.split(':')
+        return int((int(hours) * 3600 + int(minutes) * 60 + float(seconds)) * 1000)
+    except (AttributeError, ValueError):
+        return None
+
+
+def decode_event(data):
+    # all state variables of a GENA event, LastChange carries an escaped XML document of its own
+    changes = {}
+    for prop in ElementTree.fromstring(data):
+        for var in prop:
+            name = local_name(var.tag)
+            if name != 'LastChange':
+                changes[name] = var.text
+            elif var.text:
+                for instance in ElementTree.fromstring(var.text.encode()):
+                    for item in instance:
+                        channel = item.get('channel')
+                        if channel is None or channel == 'Master':
+                            changes[local_name(item.tag)] = item.get('val')
+    return changes
+
+
+def same_track(url, other):
+    # the device might echo the URL with a differently escaped query
+    return urlparse(url).path == urlparse(other).path
+
+
+def element_re(tag):
+    # value of an element regardless of its namespace prefix
+    return re.compile(rb'<(?:[\w-]+:)?' + tag.encode() + rb'(?:\s[^>]*)?>(.*?)</(?:[\w-]+:)?' + tag.encode() + rb'>',
+                      re.S)
+
+
+class ActionTemplate:
+    """
+    Envelope of one action rendered from byte fragments, only the argument values are encoded per call
+    """
+    def __init__(self, urn, action, args, results):
+        self.start = ENVELOPE_START + '<u:{} xmlns:u="{}">'.format(action, urn).encode()
+        self.end = '</u:{}>'.format(action).encode() + ENVELOPE_END
+        self.tags = [('<{}>'.format(arg).encode(), '</{}>'.format(arg).encode()) for arg in args]
+        self.response = re.compile(rb'<(?:[\w-]+:)?' + action.encode() + rb'Response[\s/>]')
+        self.results = [(result, element_re(result)) for result in results]
+
+    def render(self, values):
+        parts = [self.start]
+        for (open_tag, close_tag), value in zip(self.tags, values):
+            parts.append(open_tag)
+            parts.append(value if isinstance(value, bytes) else str(value).encode())
+            parts.append(close_tag)
+        parts.append(self.end)
+        return b''.join(parts)
+
+    def parse(self, data):
+        # pick the requested elements instead of parsing the whole response
+        if not self.response.search(data):
+            return None
+        results = {}
+        for result, pattern in self.results:
+            match = pattern.search(data)
+            if match:
+                results[result] = unescape(match.group(1).decode(), {'&quot;': '"'})
+        return results
+
+
+class SoapService:
+    """
+    Control endpoint of one UPnP service on a renderer, actions share one keep-alive connection
+    """
+    def __init__(self, host, port, url, urn):
+        self.log = getLogger('SoapService')
+        self.host = host
+        self.port = int(port)
+        self.url = url
+        self.urn = urn
+        # one action at a time per service, embedded devices do not cope with parallel requests
+        self.lock = Lock()
+        self.conn = None
+        self.templates = {}
+        self.headers = {
+            'Content-type': 'text/xml',
+            'charset': 'utf-8',
+            'User-Agent': '{}/{}'.format(__file__, '1.0')
+        }
+
+    def template(self, action, args, results):
+        key = (action, args, results)
+        template = self.templates.get(key)
+        if template is None:
+            template = self.templates[key] = ActionTemplate(self.urn, action, args, results)
+        return template
+
+    def connect(self):
+        self.conn = HTTPConnection(self.host, self.port, timeout=TIMEOUT)
+        metrics.increment('upnp.connects')
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+    def post(self, action, body):
+        # must be called with lock acquired, reconnect once if the device closed the connection in the meantime
+        headers = dict(self.headers)
+        headers['SOAPACTION'] = '"{}#{}"'.format(self.urn, action)
+        while True:
+            reused = self.conn is not None
+            if not reused:
+                self.connect()
+            try:
+                self.conn.request('POST', self.url, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (HTTPException, OSError):
+                self.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                self.close()
+            return response.status, data
+
+    def request(self, action, results=(), **args):
+        # returns the requested result elements of the response, None if the action failed
+        self.log.info('SOAP Request: ' + str(action))
+        template = self.template(action, tuple(args), results)
+        body = template.render(args.values())
+        start = monotonic()
+        try:
+            with self.lock:
+                status, data = self.post(action, body)
+        except Exception as e:
+            self.log.error('SOAP request failed: ' + str(e))
+            return None
+        finally:
+            metrics.record('upnp.' + action, monotonic() - start)
+        fault = FAULT_RE.search(data)
+        if fault:
+            self.log.error('SOAP request returned error: ' + unescape(fault.group(1).decode()))
+            return None
+        if status != 200:
+            self.log.error('SOAP request failed, response code: ' + str(status))
+            return None
+        response = template.parse(data)
+        if response is None:
+            self.log.error('SOAP request failed, no {}Response in answer'.format(action))
+        return response
+
+
+class EventSubscription:
+    """
+    GENA subscription to the events of one service, renewed with its SID until it is stopped
+    """
+    def __init__(self, host, port, url, callback):
+        self.log = getLogger('EventSubscription')
+        self.host = host
+        self.port = int(port)
+        self.url = url
+        self.callback = callback
+        self.lock = Lock()
+        self.sid = None
+        # SEQ of the last accepted event
+        self.seq = None
+        self.stop_signal = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_signal.set()
+        self.thread.join()
+
+    def request(self, method, headers):
+        conn = HTTPConnection(self.host, self.port, timeout=TIMEOUT)
+        try:
+            conn.request(method, self.url, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response
+        finally:
+            conn.close()
+
+    @staticmethod
+    def parse_timeout(value):
+        # e.g. Second-1800, infinite subscriptions are renewed like the requested timeout
+        try:
+            return int(value.split('-', 1)[1])
+        except (AttributeError, IndexError, ValueError):
+            return SUBSCRIBE_TIMEOUT
+
+    def subscribe(self):
+        headers = {
+            'User-Agent': '{}/{}'.format(__file__, '1.0'),
+            'Timeout': 'Second-{}'.format(SUBSCRIBE_TIMEOUT)
+        }
+        with self.lock:
+            sid = self.sid
+        if sid:
+            headers['SID'] = sid
+        else:
+            headers['NT'] = 'upnp:event'
+            headers['Callback'] = '<{}>'.format(self.callback)
+        response = self.request('SUBSCRIBE', headers)
+        if response.status != 200:
+            raise OSError('{} returned {}'.format('Renewal' if sid else 'SUBSCRIBE', response.status))
+        new_sid = response.getheader('SID')
+        if not new_sid:
+            raise OSError('SUBSCRIBE response without SID')
+        with self.lock:
+            if new_sid != self.sid:
+                self.log.info('Subscribed to %s with %s', self.url, new_sid)
+                self.sid = new_sid
+                self.seq = None
+        return self.parse_timeout(response.getheader('TIMEOUT'))
+
+    def unsubscribe(self):
+        with self.lock:
+            sid, self.sid = self.sid, None
+        if sid:
+            try:
+                self.request('UNSUBSCRIBE', {'SID': sid})
+            except Exception as e:
+                self.log.warning('Could not unsubscribe from %s: %s', self.url, e)
+
+    def run(self):
+        backoff = BACKOFF_MIN
+        while not self.stop_signal.is_set():
+            try:
+                timeout = self.subscribe()
+            except Exception as e:
+                self.log.warning('Subscription to %s failed, retry in %s s: %s', self.url, backoff, e)
+                # the device may have dropped the subscription, start over with a new one
+                with self.lock:
+                    self.sid = None
+                wait = backoff
+                backoff = min(backoff * 2, BACKOFF_MAX)
+            else:
+                backoff = BACKOFF_MIN
+                wait = max(timeout - RENEW_BEFORE, timeout / 2)
+            self.stop_signal.wait(wait)
+        self.unsubscribe()
+
+    def accept(self, sid, seq):
+        # False for events of a foreign or expired subscription, None for duplicate or out of order events
+        with self.lock:
+            try:
+                seq = int(seq)
+            except (TypeError, ValueError):
+                seq = None
+            if sid != self.sid:
+                # the initial event may arrive before the SUBSCRIBE response
+                if self.sid is not None or seq != 0:
+                    return False
+            elif seq is not None and self.seq is not None and seq <= self.seq:
+                return None
+            if seq is not None:
+                self.seq = seq
+            return True
+
+    def is_active(self):
+        with self.lock:
+            return self.sid is not None
+
+
+class DeviceState:
+    """
+    Immutable snapshot of the state variables evented by a renderer and when each of them was reported
+    """
+    __slots__ = ('values', 'updated', 'clock')
+
+    def __init__(self, values=None, updated=None, clock=None):
+        self.values = values or {}
+        self.updated = updated or {}
+        # (position in ms, since when, running, when it was reported) of the evented track position
+        self.clock = clock
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def age(self, name):
+        updated = self.updated.get(name)
+        return monotonic() - updated if updated is not None else None
+
+    def position(self, now):
+        position, since, running, _ = self.clock
+        if running:
+            position += int((now - since) * 1000)
+        return position
+
+    def merge(self, changes):
+        now = monotonic()
+        values = dict(self.values)
+        values.update(changes)
+        updated = dict(self.updated)
+        updated.update(dict.fromkeys(changes, now))
+        clock = self.clock
+        state = changes.get('TransportState')
+        position = parse_time(changes.get('RelativeTimePosition'))
+        if position is not None:
+            running = values.get('TransportState') == 'PLAYING'
+            clock = (position, now, running, now)
+        elif 'CurrentTrackURI' in changes and changes['CurrentTrackURI'] != self.values.get('CurrentTrackURI'):
+            # the position of the previous track does not apply anymore
+            clock = None
+        elif state is not None and clock is not None:
+            # stop or restart the clock at the position it reached when the state changed
+            clock = (self.position(now), now, state == 'PLAYING', clock[3])
+        return DeviceState(values, updated, clock)
+
+    def elapsed(self):
+        # evented track position advanced while the device was playing, None if unknown or too old
+        if self.clock is None:
+            return None
+        now = monotonic()
+        if now - self.clock[3] > POSITION_MAX_AGE:
+            return None
+        return self.position(now)
+
+
+class NotificationServer(ThreadingHTTPServer):
+    """
+    Receives the GENA events of all subscriptions of a device, device.on_event() gets the decoded variables
+    """
+    daemon_threads = True
+
+    def __init__(self, device, subscriptions, address):
+        ThreadingHTTPServer.__init__(self, address, NotificationHandler)
+        self.log = getLogger('NotificationServer')
+        self.device = device
+        self.subscriptions = subscriptions
+        # requests are handled in parallel but events are applied one at a time in SEQ order
+        self.lock = Lock()
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+    def do_NOTIFY(self):
+        data = self.rfile.read(int(self.headers.get('content-length') or 0))
+        sid = self.headers.get('SID')
+        seq = self.headers.get('SEQ')
+        try:
+            changes = decode_event(data)
+        except Exception as e:
+            self.server.log.error('Could not parse notification: ' + str(e))
+            changes = None
+        with self.server.lock:
+            accepted = False
+            for subscription in self.server.subscriptions:
+                accepted = subscription.accept(sid, seq)
+                if accepted is not False:
+                    break
+            if accepted and changes:
+                try:
+                    self.server.device.on_event(changes)
+                except Exception as e:
+                    self.server.log.error('Could not handle notification: ' + str(e))
+        # an unknown SID tells the device to drop that subscription
+        self.send_response(200 if accepted is not False else 412)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        if not accepted:
+            self.server.log.debug('Discard notification %s of %s', seq, sid)
+
+    def log_message(self, fmt, *args):
+        return
+
+
+class UpnpRenderer:
+    """
+    AVTransport and RenderingControl player driven by GENA events, drivers add device specific URLs, volume
+    scaling and source checks
+    """
+    def __init__(self, manager, config, name, control_url, event_url, rend_url, rend_event_url):
+        self.log = getLogger(name)
+        self.ip = config.player.ip
+        self.port = config.player.port
+        self.host_ip = config.player.host_ip
+        self.notify_port = config.player.notify_port
+        self.play_timeout = config.player.play_timeout
+
+        self.lock = Lock()
+        self.action = 'stop'
+        # set by the notification handler once the device reports PLAYING
+        self.playing = Event()
+        self.current_uri = None
+        self.next_url = None
+        self.request_next = False
+        self.is_paused = False
+        self.ended_at = None
+        self.manager = manager
+        self.event = Condition()
+        self.event_pending = False
+
+        self.av_transport = SoapService(self.ip, self.port, control_url, AV_URN)
+        self.rendering = SoapService(self.ip, self.port, rend_url, REND_URN)
+
+        self.stop_signal = Event()
+        self.monitor_thread = Thread(target=self.monitor, daemon=True)
+        # state variables reported by AVTransport and RenderingControl events
+        self.device_state = DeviceState()
+        callback = 'http://{}:{}'.format(self.host_ip, self.notify_port)
+        self.av_events = EventSubscription(self.ip, self.port, event_url, callback)
+        self.rendering_events = EventSubscription(self.ip, self.port, rend_event_url, callback)
+        self.notify_server = NotificationServer(self, (self.av_events, self.rendering_events),
+                                                ('0.0.0.0', int(self.notify_port)))
+        self.notify_server_thread = Thread(target=self.notify_server.serve_forever, daemon=True)
+
+    def start(self):
+        self.monitor_thread.start()
+        self.notify_server_thread.start()
+        self.av_events.start()
+        self.rendering_events.start()
+
+    def _position_info(self, instance_id=0):
+        return self.av_transport.request('GetPositionInfo', ('RelTime',), InstanceID=instance_id)
+
+    def _set_current_media(self, media_url, thumb_url='http://via.placeholder.com/350x350'):
+        response = self.av_transport.request('SetAVTransportURI', InstanceID=0, CurrentURI=media_url,
+                                             CurrentURIMetaData=meta_data(thumb_url))
+        return response is not None
+
+    def _set_next_media(self, media_url, thumb_url='http://via.placeholder.com/350x350'):
+        response = self.av_transport.request('SetNextAVTransportURI', InstanceID=0, NextURI=media_url,
+                                             NextURIMetaData=meta_data(thumb_url))
+        return response is not None
+
+    def _transport_state(self):
+        response = self.av_transport.request('GetTransportInfo', ('CurrentTransportState',), InstanceID=0)
+        return response.get('CurrentTransportState') if response else None
+
+    def _wait_for_playing(self):
+        # ask the device if the notification does not arrive in time, then retry once
+        for attempt in range(2):
+            if self.playing.wait(self.play_timeout):
+                return True
+            state = self._transport_state()
+            if state == 'PLAYING':
+                self.log.warning('Missed PLAYING notification')
+                self.action = 'play'
+                return True
+            if attempt == 0:
+                self.log.warning('Device did not start playing within %s s (state %s), retry', self.play_timeout, state)
+                self._play()
+        self.log.error('Device did not start playing')
+        return False
+
+    def _play(self, speed=1):
+        response = self.av_transport.request('Play', InstanceID=0, Speed=speed)
+        return response is not None
+
+    def play(self, music, thumb):
+        with self.lock:
+            self.log.debug('Play: ' + music + ' with thumbnail ' + thumb)
+            self.next_url = None
+            self.ended_at = None
+            self.current_uri = music
+            self.playing.clear()
+            self._set_current_media(music, thumb_url=thumb)
+            self._play()
+            started = self._wait_for_playing()
+            self.request_next = started
+            self.is_paused = False
+        return started
+
+    def preload_next(self, music, thumb):
+        with self.lock:
+            if self.next_url == music:
+                return True
+            if self._set_next_media(music, thumb_url=thumb):
+                self.next_url = music
+                return True
+            return False
+
+    def clear_next(self):
+        # an empty next uri makes the device stop after the current track
+        with self.lock:
+            if self.next_url is None:
+                return True
+            response = self.av_transport.request('SetNextAVTransportURI', InstanceID=0, NextURI='',
+                                                 NextURIMetaData='')
+            if response is None:
+                return False
+            self.next_url = None
+            return True
+
+    def is_advanced(self):
+        # device started the preloaded track on its own
+        with self.lock:
+            if self.next_url and self.current_uri and same_track(self.current_uri, self.next_url):
+                self.next_url = None
+                return True
+            return False
+
+    def pause(self):
+        with self.lock:
+            self.is_paused = True
+            response = self.av_transport.request('Pause', InstanceID=0, Speed=1)
+        return response is not None
+
+    def stop(self):
+        with self.lock:
+            self.request_next = False
+            self.next_url = None
+            response = self.av_transport.request('Stop', InstanceID=0, Speed=1)
+        return response is not None
+
+    def resume(self):
+        with self.lock:
+            self.is_paused = False
+            return self._play()
+
+    def seek(self, position):
+        secs = int(round(position / 1000))
+        hour = int(secs / 3600)
+        minute = int((secs / 60) % 60)
+        second = int(secs - (hour * 3600) - (minute * 60))
+        position = str(hour) + ':' + str(minute).zfill(2) + ':' + str(second).zfill(2)
+        response = self.av_transport.request('Seek', InstanceID=0, Unit='REL_TIME', Target=position)
+        return response is not None
+
+    def _evented(self, name, subscription):
+        # last reported value of a state variable, None while the subscription is down
+        if subscription.is_active():
+            return self.device_state.get(name)
+        return None
+
+    def on_event(self, changes):
+        # called by the notification server for each accepted event
+        self.device_state = self.device_state.merge(changes)
+        uri = changes.get('CurrentTrackURI') or changes.get('AVTransportURI')
+        if uri:
+            self.current_uri = uri
+        current_state = changes.get('TransportState')
+        if current_state == 'PLAYING':
+            self.action = 'play'
+            self.playing.set()
+        elif current_state == 'STOPPED':
+            self.action = 'stop'
+        elif current_state == 'NO_MEDIA_PRESENT':
+            self.action = 'stop'
+        elif current_state == 'PAUSED_PLAYBACK':
+            self.action = 'pause'
+        elif current_state == 'TRANSITIONING':
+            self.action = 'transition'
+        if 'Volume' in changes or 'Mute' in changes:
+            self.manager.player_state_changed()
+        self.signal()
+
+    def get_elapsed(self):
+        elapsed = self.device_state.elapsed() if self.av_events.is_active() else None
+        if elapsed is not None:
+            return elapsed
+        info = self._position_info()
+        if info:
+            elapsed = parse_time(info.get('RelTime'))
+            if elapsed is not None:
+                return elapsed
+        return 0
+
+    def is_muted(self):
+        mute = self._evented('Mute', self.rendering_events)
+        if mute is None:
+            response = self.rendering.request('GetMute', ('CurrentMute',), InstanceID=0, Channel='Master')
+            mute = response.get('CurrentMute') if response else None
+        return mute in ('1', 'true', 'True')
+
+    def _device_volume(self):
+        # volume in device units, None if unknown
+        vol = self._evented('Volume', self.rendering_events)
+        if vol is None:
+            response = self.rendering.request('GetVolume', ('CurrentVolume',), InstanceID=0, Channel='Master')
+            vol = response.get('CurrentVolume') if response else None
+        try:
+            return int(vol)
+        except (TypeError, ValueError):
+            return None
+
+    def _set_device_volume(self, vol):
+        response = self.rendering.request('SetVolume', InstanceID=0, Channel='Master', DesiredVolume=vol)
+        return response is not None
+
+    def signal(self):
+        # called by the notification handler after the device state changed
+        with self.event:
+            self.event_pending = True
+            self.event.notify_all()
+
+    def wait_for_event(self, timeout):
+        with self.event:
+            self.event.wait_for(lambda: self.event_pending or self.stop_signal.is_set(), timeout)
+            self.event_pending = False
+
+    def is_waiting(self):
+        if (self.action != 'pause' and self.action != 'stop') or self.is_paused:
+            self.ended_at = None
+            return False
+        # the device may report STOPPED before it starts the preloaded track
+        if self.next_url and self.action == 'stop':
+            now = monotonic()
+            if self.ended_at is None:
+                self.ended_at = now
+            if now - self.ended_at < ADVANCE_GRACE:
+                return False
+        self.ended_at = None
+        return True
+
+    def track_ended(self):
+        # device stopped at the end of the track without starting a preloaded one
+        self.log.info('Detected end of song, play next one')
+        self.manager.auto_next()
+
+    def check_source(self):
+        # called by the monitor while the bridge plays, e.g. to stop if the device switched to another input
+        pass
+
+    def monitor(self):
+        while not self.stop_signal.is_set():
+            self.wait_for_event(ADVANCE_GRACE if self.ended_at is not None else MONITOR_INTERVAL)
+            if self.request_next and self.is_advanced():
+                self.log.info('Detected start of preloaded song')
+                self.manager.preloaded_started()
+            elif self.request_next and self.is_waiting():
+                self.track_ended()
+            if self.request_next:
+                self.check_source()
+
+    def is_ready(self):
+        url = 'http://{}'.format(self.ip)
+        try:
+            urlopen(url)
+            return True
+        except:
+            return False
+
+    def wait_for_ready(self):
+        while not self.is_ready():
+            sleep(2)
+
+    def kill(self):
+        self.stop_signal.set()
+        self.signal()
+        self.stop()
+        self.av_events.stop()
+        self.rendering_events.stop()
+        self.notify_server.shutdown()
+        self.notify_server.server_close()
+        self.notify_server_thread.join()
+        self.monitor_thread.join()
+        self.av_transport.close()
+        self.rendering.close()
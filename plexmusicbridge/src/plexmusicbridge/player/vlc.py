@@ -1,34 +1,59 @@
 import vlc
-from threading import Thread, Event, Lock
-from time import sleep
+from threading import Thread, Event, Lock, Condition
+from time import monotonic
 from logging import getLogger
+from os import environ
+
+# libvlc events wake up the monitor, it only polls as a safety net every MONITOR_INTERVAL seconds
+MONITOR_INTERVAL = 5
+# seconds the list player may take to start the preloaded track after the current one ended
+ADVANCE_GRACE = 1
 
 
 class PlayerConfig:
     def __init__(self):
+        # size of the album art served by the bridge, None to pass the Plex thumb url
+        self.art_size = None
+        # seconds libvlc may take to start a track before it is started again
+        self.play_timeout = None
         self.rewrite_http = False
         self.rewrite_host = False
 
     def parse_env(self):
-        pass
+        self.play_timeout = float(environ.get('PLAY_TIMEOUT') or 5)
 
     def save_arguments(self, args):
-        pass
+        self.play_timeout = float(args.play_timeout or 5)
 
     @staticmethod
     def add_arguments(parser):
-        pass
+        parser.add_argument('--play_timeout', help='Seconds to wait for VLC to start playback')
 
 
 class Player:
     def __init__(self, manager, config):
         self.log = getLogger('VLCPlayer')
+        self.play_timeout = config.player.play_timeout or 5
         self.stop_thread = Event()
         self.lock = Lock()
         self.request_next = False
         self.paused = False
         self.media_player = vlc.MediaPlayer()
+        # the list player moves on to a preloaded track without a gap
+        self.list_player = vlc.MediaListPlayer()
+        self.list_player.set_media_player(self.media_player)
+        self.media_list = None
+        self.next_media = None
+        self.ended_at = None
         self.manager = manager
+        self.event = Condition()
+        self.event_pending = False
+        self.playing = Event()
+        events = self.media_player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerPlaying, self.on_playing)
+        for event_type in (vlc.EventType.MediaPlayerEndReached, vlc.EventType.MediaPlayerStopped,
+                           vlc.EventType.MediaPlayerEncounteredError, vlc.EventType.MediaPlayerMediaChanged):
+            events.event_attach(event_type, self.on_event)
         self.monitor_thread = Thread(target=self.monitor, daemon=True)
 
     def start(self):
@@ -37,19 +62,70 @@ class Player:
     def play(self, track_url, thumb_url):
         with self.lock:
             self.log.info('Play: ' + track_url)
-            media = self.media_player.get_instance().media_new(track_url)
-            self.media_player.set_media(media)
-            self.media_player.play()
-            while not self.media_player.is_playing():
-                sleep(0.05)
-            self.request_next = True
+            self.media_list = self.media_player.get_instance().media_list_new([track_url])
+            self.next_media = None
+            self.ended_at = None
+            self.list_player.set_media_list(self.media_list)
+            self.playing.clear()
+            self.list_player.play_item_at_index(0)
+            started = self.wait_for_playing()
+            self.request_next = started
             self.paused = False
+        return started
+
+    def wait_for_playing(self):
+        for attempt in range(2):
+            if self.playing.wait(self.play_timeout) or self.media_player.is_playing():
+                return True
+            if attempt == 0:
+                self.log.warning('Track did not start within %s s, retry', self.play_timeout)
+                self.list_player.play_item_at_index(0)
+        self.log.error('Track did not start')
+        return False
+
+    def preload_next(self, track_url, thumb_url):
+        with self.lock:
+            if self.media_list is None:
+                return False
+            media = self.media_player.get_instance().media_new(track_url)
+            self.media_list.lock()
+            # replace a previously preloaded track that has not been started yet
+            current = self.media_list.index_of_item(self.media_player.get_media())
+            while 0 <= current < self.media_list.count() - 1:
+                self.media_list.remove_index(current + 1)
+            self.media_list.add_media(media)
+            self.media_list.unlock()
+            self.next_media = media
+            return True
+
+    def clear_next(self):
+        with self.lock:
+            if self.media_list is None or self.next_media is None:
+                return True
+            self.media_list.lock()
+            current = self.media_list.index_of_item(self.media_player.get_media())
+            while 0 <= current < self.media_list.count() - 1:
+                self.media_list.remove_index(current + 1)
+            self.media_list.unlock()
+            self.next_media = None
+            return True
+
+    def is_advanced(self):
+        with self.lock:
+            if self.next_media is None or not self.request_next:
+                return False
+            media = self.media_player.get_media()
+            if media is not None and media.get_mrl() == self.next_media.get_mrl():
+                self.next_media = None
+                return True
+            return False
 
     def stop(self):
-        self.media_player.stop()
+        self.list_player.stop()
         with self.lock:
             self.request_next = False
             self.paused = False
+            self.next_media = None
 
     def pause(self):
         with self.lock:
@@ -83,22 +159,50 @@ class Player:
     def kill(self):
         self.stop()
         self.stop_thread.set()
+        self.on_event(None)
         self.monitor_thread.join()
 
+    def on_playing(self, event):
+        self.playing.set()
+
+    def on_event(self, event):
+        # runs on a libvlc thread, must not call back into libvlc
+        with self.event:
+            self.event_pending = True
+            self.event.notify_all()
+
+    def wait_for_event(self, timeout):
+        with self.event:
+            self.event.wait_for(lambda: self.event_pending or self.stop_thread.is_set(), timeout)
+            self.event_pending = False
+
     def is_waiting(self):
         with self.lock:
-            if self.request_next and not self.paused and not self.media_player.is_playing():
-                self.request_next = False
-                return True
-            else:
+            state = self.media_player.get_state()
+            if not self.request_next or self.paused or state not in (vlc.State.Ended, vlc.State.Stopped,
+                                                                    vlc.State.Error):
+                self.ended_at = None
                 return False
+            # the list player moves on to a preloaded track by itself
+            if self.next_media is not None and state == vlc.State.Ended:
+                now = monotonic()
+                if self.ended_at is None:
+                    self.ended_at = now
+                if now - self.ended_at < ADVANCE_GRACE:
+                    return False
+            self.request_next = False
+            self.ended_at = None
+            return True
 
     def monitor(self):
         while not self.stop_thread.is_set():
-            if self.is_waiting():
+            self.wait_for_event(ADVANCE_GRACE if self.ended_at is not None else MONITOR_INTERVAL)
+            if self.is_advanced():
+                self.log.debug('Preloaded song started')
+                self.manager.preloaded_started()
+            elif self.is_waiting():
                 self.log.debug('Request next song')
                 self.manager.auto_next()
-            sleep(0.3)
 
     def is_ready(self):
         return True
@@ -0,0 +1,178 @@
+from logging import getLogger, DEBUG
+from threading import Lock, Thread
+from time import monotonic
+from .metrics import metrics
+
+# seconds until the interpolated elapsed time is checked against the player and until volume/mute are read again
+ELAPSED_RESYNC = 15
+VOLUME_TTL = 30
+
+
+class PlayerStateCache:
+    """
+    Serves elapsed time, volume and mute state without waiting for the player, stale values are refreshed in the
+    background
+    """
+    def __init__(self, player, player_lock):
+        self.log = getLogger('PlayerStateCache')
+        self.player = player
+        self.player_lock = player_lock
+        self.lock = Lock()
+        # last authoritative elapsed time in ms and when it was read, interpolated while running
+        self.elapsed = None
+        self.elapsed_at = 0.0
+        self.running = False
+        # set on pause and resume, the next read asks the player for the position right away
+        self.resync = False
+        self.volume = None
+        self.volume_at = 0.0
+        self.muted = None
+        self.muted_at = 0.0
+        # bumped on every transition, so a refresh that raced with one is dropped
+        self.version = 0
+        self.volume_version = 0
+        self.refreshing = False
+
+    def interpolate(self, now):
+        if self.running:
+            return self.elapsed + int((now - self.elapsed_at) * 1000)
+        return self.elapsed
+
+    def stale(self, now):
+        return (self.elapsed is None or self.resync or now - self.elapsed_at >= ELAPSED_RESYNC,
+                self.volume is None or now - self.volume_at >= VOLUME_TTL,
+                self.muted is None or now - self.muted_at >= VOLUME_TTL)
+
+    def refresh(self):
+        # must be called with lock acquired, at most one refresh runs at a time
+        if not self.refreshing:
+            self.refreshing = True
+            Thread(target=self.refresh_run, daemon=True).start()
+
+    def refresh_run(self):
+        try:
+            with self.lock:
+                version = self.version
+                volume_version = self.volume_version
+                read_elapsed, read_volume, read_muted = self.stale(monotonic())
+            if read_elapsed:
+                with self.player_lock:
+                    elapsed = self.player.get_elapsed()
+                metrics.increment('player.elapsed_reads')
+                with self.lock:
+                    if version == self.version:
+                        if self.elapsed is not None and self.log.isEnabledFor(DEBUG):
+                            self.log.debug('Elapsed time drift: %s ms', elapsed - self.interpolate(monotonic()))
+                        self.elapsed = elapsed
+                        self.elapsed_at = monotonic()
+                        self.resync = False
+            if read_volume:
+                with self.player_lock:
+                    volume = self.player.get_volume()
+                metrics.increment('player.volume_reads')
+                with self.lock:
+                    if volume_version == self.volume_version:
+                        self.volume = volume
+                        self.volume_at = monotonic()
+            if read_muted:
+                with self.player_lock:
+                    muted = self.player.is_muted()
+                metrics.increment('player.mute_reads')
+                with self.lock:
+                    if volume_version == self.volume_version:
+                        self.muted = muted
+                        self.muted_at = monotonic()
+        except Exception as e:
+            self.log.error('Could not read player state: ' + str(e))
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def get_elapsed(self):
+        with self.lock:
+            now = monotonic()
+            if any(self.stale(now)):
+                self.refresh()
+            if self.elapsed is None:
+                return 0
+            return self.interpolate(now)
+
+    def get_volume(self):
+        # None until the player was asked once
+        with self.lock:
+            if any(self.stale(monotonic())):
+                self.refresh()
+            return self.volume
+
+    def is_muted(self):
+        with self.lock:
+            if any(self.stale(monotonic())):
+                self.refresh()
+            return bool(self.muted)
+
+    def started(self):
+        # a new track starts at 0 ms
+        with self.lock:
+            self.version += 1
+            self.elapsed = 0
+            self.elapsed_at = monotonic()
+            self.running = True
+            self.resync = False
+
+    def loading(self):
+        # a new track is being handed to the player, it is reported at 0 ms until it started
+        with self.lock:
+            self.version += 1
+            self.elapsed = 0
+            self.elapsed_at = monotonic()
+            self.running = False
+            self.resync = False
+
+    def resumed(self):
+        # restart from the frozen time and correct it with the position the player resumed at
+        with self.lock:
+            self.version += 1
+            if self.elapsed is not None:
+                self.elapsed_at = monotonic()
+            self.running = True
+            self.resync = True
+            self.refresh()
+
+    def paused(self):
+        # freeze the interpolated time and correct it with the position the player paused at
+        with self.lock:
+            self.version += 1
+            if self.elapsed is not None:
+                now = monotonic()
+                self.elapsed = self.interpolate(now)
+                self.elapsed_at = now
+            self.running = False
+            self.resync = True
+            self.refresh()
+
+    def stopped(self):
+        with self.lock:
+            self.version += 1
+            self.running = False
+            self.resync = False
+            self.elapsed = None
+
+    def seeked(self, offset):
+        # optimistic, the next resync corrects it
+        with self.lock:
+            self.version += 1
+            self.elapsed = offset
+            self.elapsed_at = monotonic()
+
+    def volume_set(self, volume):
+        with self.lock:
+            self.volume_version += 1
+            self.volume = volume
+            self.volume_at = monotonic()
+
+    def invalidate_volume(self):
+        # volume or mute changed outside of the bridge
+        with self.lock:
+            self.volume_version += 1
+            self.volume = None
+            self.muted = None
@@ -1,15 +1,65 @@
 from logging import getLogger
-from random import randint
+from random import Random, randrange
+from array import array
+
+
+class Track:
+    __slots__ = ('rating_key', 'key', 'url', 'thumb', 'duration', 'pq_item_id', 'title')
+
+    def __init__(self, rating_key, key, url, thumb, duration, pq_item_id, title):
+        self.rating_key = rating_key
+        self.key = key
+        self.url = url
+        self.thumb = thumb
+        self.duration = duration
+        self.pq_item_id = pq_item_id
+        self.title = title
+
+    @classmethod
+    def from_dct(cls, dct):
+        media = dct['Media']
+        if isinstance(media, list):
+            media = media[0]
+        part = media['Part']
+        if isinstance(part, list):
+            part = part[0]
+        return cls(dct['@ratingKey'], dct['@key'], part['@key'], dct.get('@thumb', ''), dct.get('@duration', '0'),
+                   dct['@playQueueItemID'], dct.get('@title', ''))
+
+    @classmethod
+    def from_element(cls, elem):
+        attrs = elem.attrib
+        part = elem.find('Media/Part')
+        return cls(attrs['ratingKey'], attrs['key'], part.get('key'), attrs.get('thumb', ''),
+                   attrs.get('duration', '0'), attrs['playQueueItemID'], attrs.get('title', ''))
 
 
 class PlayQueue:
     def __init__(self):
         self.log = getLogger('PlayQueue')
-        self.dct = None
-        self.played = []
-        self.previous = []
+        # compact track store, built once per update from the PMS response
+        self.tracks = None
+        self.rating_key_pos = {}
+        self.pq_item_pos = {}
+        self.pq_id = ''
+        self.pq_version = ''
+        self.selected_item_off = 0
+        self.loaded = 0
+        self.generation = 0
+        # state of a streamed play queue, streaming until finish() ran for the current generation
+        self.streaming = False
+        self.stream_selected_id = None
+        self.stream_start = None
+        self.stream_count = 0
+        self.stream_buffer = []
+        # shuffle permutation of positions and its inverse, walked with order_pos
+        self.seed = None
+        self.order = array('l')
+        self.order_index = array('l')
+        self.order_pos = 0
         self.position = 0
         self.current_key = ''
+        self.current_item_id = ''
         self.shuffle = False
         self.repeat = 0
 
@@ -17,7 +67,10 @@ class PlayQueue:
         self.repeat = repeat
 
     def set_shuffle(self, shuffle):
-        self.shuffle = bool(shuffle)
+        shuffle = bool(shuffle)
+        if shuffle and not self.shuffle and self.tracks is not None:
+            self.shuffle_order(self.position)
+        self.shuffle = shuffle
 
     def get_repeat(self):
         return self.repeat
@@ -25,28 +78,76 @@ class PlayQueue:
     def get_shuffle(self):
         return int(self.shuffle)
 
-    def get_random_pos(self):
-        positions = range(self.get_length())
-        positions = [pos for pos in positions if self.get_rating_key(pos) not in self.played]
-        i = randint(0, len(positions) - 1)
-        return positions[i]
+    def shuffle_order(self, first=None):
+        # one seeded permutation per shuffle, the given position is played first
+        self.seed = randrange(2 ** 32)
+        positions = list(range(self.get_length()))
+        if first is not None:
+            positions[0], positions[first] = positions[first], positions[0]
+            rest = positions[1:]
+            Random(self.seed).shuffle(rest)
+            positions[1:] = rest
+        else:
+            Random(self.seed).shuffle(positions)
+        self.set_order(positions, 0)
+        self.log.debug('New shuffle order with seed %s', self.seed)
+
+    def set_order(self, positions, order_pos):
+        self.order = array('l', positions)
+        self.order_index = array('l', bytes(self.order.itemsize * len(positions)))
+        for i, pos in enumerate(self.order):
+            self.order_index[pos] = i
+        self.order_pos = order_pos
+
+    def merge_order(self, old_tracks):
+        # keep the permutation stable across a refresh, newly added tracks are shuffled in at the end
+        positions = []
+        for pos in self.order:
+            if old_tracks[pos] is None:
+                continue
+            new_pos = self.pq_item_pos.get(old_tracks[pos].pq_item_id)
+            if new_pos is not None:
+                positions.append(new_pos)
+        known = set(positions)
+        added = [pos for pos in range(self.get_length()) if pos not in known]
+        Random(self.seed).shuffle(added)
+        positions.extend(added)
+        self.set_order(positions, 0)
+        if self.position is not None:
+            self.order_pos = self.order_index[self.position]
+
+    def contains(self, key):
+        return key.split('/')[-1] in self.rating_key_pos
 
     def set_pos(self, key):
         path = key.split('/')
         self.position = self.get_position(path[-1])
+        if self.shuffle and self.position is not None and self.order:
+            # move the selected track right behind the current one in the shuffle order,
+            # already played tracks are replayed without touching the order
+            i = self.order_index[self.position]
+            if i > self.order_pos:
+                self.order_pos += 1
+                self.swap_order(i, self.order_pos)
+
+    def swap_order(self, i, j):
+        a, b = self.order[i], self.order[j]
+        self.order[i], self.order[j] = b, a
+        self.order_index[a], self.order_index[b] = j, i
 
     def next_pos(self, auto):
         if self.shuffle:
-            if len(self.played) < self.get_length():
+            if self.order_pos + 1 < len(self.order):
                 if self.repeat != 1 or not auto:
-                    self.position = self.get_random_pos()
+                    self.order_pos += 1
+                    self.position = self.order[self.order_pos]
                 return True
-            elif len(self.played) == self.get_length():
+            elif self.order_pos + 1 == len(self.order):
                 if self.repeat == 1 and auto:
                     return True
                 elif self.repeat == 2:
-                    self.played = []
-                    self.position = self.get_random_pos()
+                    self.shuffle_order()
+                    self.position = self.order[self.order_pos]
                     return True
                 else:
                     return False
@@ -62,7 +163,6 @@ class PlayQueue:
                 if self.repeat == 1 and auto:
                     return True
                 elif self.repeat == 2:
-                    self.played = []
                     self.position = 0
                     return True
                 else:
@@ -71,27 +171,198 @@ class PlayQueue:
                 self.log.error('Unknown state to get the next track')
                 return False
 
+    def peek_next_pos(self):
+        # position next_pos(True) will move to, None if the queue ends or the next track is not known yet
+        if self.repeat == 1:
+            return self.position
+        if self.shuffle:
+            if self.order_pos + 1 < len(self.order):
+                return self.order[self.order_pos + 1]
+            return None
+        if self.position + 1 < self.get_length():
+            return self.position + 1
+        if self.repeat == 2:
+            return 0
+        return None
+
     def prev_pos(self):
         if self.shuffle:
-            if len(self.previous) > 1:
-                self.position = self.get_position(self.previous.pop())
-                self.position = self.get_position(self.previous.pop())
+            if self.order_pos > 0:
+                self.order_pos -= 1
+                self.position = self.order[self.order_pos]
         else:
             if self.position > 0:
                 self.position -= 1
 
-    def update(self, dct, refresh):
-        self.dct = dct
-        if refresh:
+    @staticmethod
+    def parse_tracks(container):
+        tracks = container.get('Track', [])
+        if not isinstance(tracks, list):
+            tracks = [tracks]
+        return [Track.from_dct(track) for track in tracks]
+
+    def set_tracks(self, tracks):
+        # unloaded positions of a windowed queue are kept as None
+        self.tracks = tracks
+        self.generation += 1
+        self.streaming = False
+        self.rating_key_pos = {}
+        self.pq_item_pos = {}
+        self.loaded = 0
+        for pos, track in enumerate(self.tracks):
+            if track is not None:
+                # keep the first occurrence if a track was queued twice
+                self.rating_key_pos.setdefault(track.rating_key, pos)
+                self.pq_item_pos[track.pq_item_id] = pos
+                self.loaded += 1
+
+    def update(self, dct):
+        # replace the tracks of the current queue, the position follows the current item
+        container = dct['MediaContainer']
+        old_tracks = self.tracks
+        self.set_tracks(self.parse_tracks(container))
+        self.pq_id = container['@playQueueID']
+        self.pq_version = container['@playQueueVersion']
+        self.selected_item_off = int(container.get('@playQueueSelectedItemOffset', 0))
+
+        self.position = self.pq_item_pos.get(self.current_item_id)
+        if self.position is None:
             self.position = self.get_position(self.current_key)
+        if self.shuffle:
+            if self.order and old_tracks is not None:
+                self.merge_order(old_tracks)
+            else:
+                self.shuffle_order(self.position)
+        self.log.info('Current position: ' + str(self.position))
+        self.log.debug('Current play queue: %s', self)
+
+    def begin(self, attrs):
+        # start loading a streamed play queue, returns the generation the tracks have to be added with
+        total = int(attrs.get('playQueueTotalCount', attrs.get('size', 0)))
+        self.set_tracks([None] * total)
+        self.streaming = True
+        self.pq_id = attrs['playQueueID']
+        self.pq_version = attrs['playQueueVersion']
+        self.selected_item_off = int(attrs.get('playQueueSelectedItemOffset', 0))
+        self.position = self.selected_item_off
+        self.stream_selected_id = attrs.get('playQueueSelectedItemID')
+        # without a selected item the response is expected to start with the first track
+        self.stream_start = None if self.stream_selected_id else 0
+        self.stream_count = 0
+        self.stream_buffer = []
+        if self.shuffle:
+            self.shuffle_order(self.position)
+        return self.generation
+
+    def add_track(self, generation, track):
+        # returns False if the queue has been replaced in the meantime
+        if generation != self.generation:
+            return False
+        if self.stream_start is None:
+            # buffer tracks until the offset of the response is known from the selected item
+            self.stream_buffer.append(track)
+            if track.pq_item_id != self.stream_selected_id:
+                return True
+            self.stream_start = self.selected_item_off - len(self.stream_buffer) + 1
+            tracks, self.stream_buffer = self.stream_buffer, []
+            for buffered in tracks:
+                self.place_track(buffered)
+        else:
+            self.place_track(track)
+        return True
+
+    def place_track(self, track):
+        pos = self.stream_start + self.stream_count
+        self.stream_count += 1
+        if pos < 0 or pos >= len(self.tracks):
+            self.log.error('Streamed track out of range: ' + str(pos))
+            return
+        self.tracks[pos] = track
+        self.rating_key_pos.setdefault(track.rating_key, pos)
+        self.pq_item_pos[track.pq_item_id] = pos
+        self.loaded += 1
+        if pos == self.position:
+            self.current_key = track.rating_key
+            self.current_item_id = track.pq_item_id
+
+    def finish(self, generation):
+        if generation != self.generation:
+            return
+        self.streaming = False
+        if self.stream_start is None:
+            self.log.error('Selected item not found in streamed play queue')
+            self.stream_buffer = []
+        self.log.info('Loaded %s of %s tracks, current position: %s', self.loaded, len(self.tracks), self.position)
+        self.log.debug('Current play queue: %s', self)
+
+    def fill(self, dct):
+        # replace a partially loaded queue by the full one, keeping the position if the queue did not change
+        position = self.position
+        version = self.pq_version
+        self.update(dct)
+        if version == self.pq_version and position is not None and position < self.get_length():
+            self.position = position
+            if self.shuffle:
+                self.order_pos = self.order_index[position]
+
+    def merge_window(self, dct):
+        # merge a window around the current item, returns False if the window can not be placed
+        container = dct['MediaContainer']
+        tracks = self.parse_tracks(container)
+        total = int(container.get('@playQueueTotalCount', len(tracks)))
+        selected_id = container.get('@playQueueSelectedItemID')
+        selected_off = int(container.get('@playQueueSelectedItemOffset', 0))
+        start = None
+        for i, track in enumerate(tracks):
+            if track.pq_item_id == selected_id:
+                start = selected_off - i
+                break
+        if self.tracks is None or start is None or start < 0 or start + len(tracks) > total:
+            return False
+
+        version = container['@playQueueVersion']
+        if version == self.pq_version and total == len(self.tracks):
+            # unchanged queue, only fill in the window
+            store = self.tracks
         else:
-            self.position = self.get_selected_item_off()
-            self.current_key = self.get_rating_key()
+            # tracks outside of the window might have moved, load them again on demand
+            self.log.info('Play queue version changed (%s -> %s)', self.pq_version, version)
+            store = [None] * total
+        store[start:start + len(tracks)] = tracks
+        self.set_tracks(store)
+        self.pq_version = version
+        self.selected_item_off = selected_off
+        position = self.pq_item_pos.get(self.current_item_id)
+        if position is None:
+            return False
+        self.position = position
         self.log.info('Current position: ' + str(self.position))
-        self.log.info('Current play queue: ' + str(self))
+        self.log.debug('Current play queue: %s', self)
+        return True
+
+    def is_loaded(self, position=None):
+        if position is None:
+            position = self.position
+        # the position is None if the current item was removed by a refresh
+        return self.tracks is not None and position is not None and 0 <= position < len(self.tracks) \
+            and self.tracks[position] is not None
+
+    def is_complete(self):
+        return self.tracks is not None and self.loaded == len(self.tracks)
+
+    def needs_window(self, margin):
+        # True if a track close to the current position is not loaded yet, a streamed queue is loaded to the end first
+        if self.is_complete() or self.position is None or self.streaming:
+            return False
+        start = max(0, self.position - margin)
+        end = min(len(self.tracks), self.position + margin + 1)
+        if self.repeat == 2 and not self.is_loaded(0):
+            return True
+        return any(track is None for track in self.tracks[start:end])
 
     def is_empty(self):
-        return True if self.dct is None else False
+        # a streamed queue is empty until the current track has been parsed
+        return not self.is_loaded()
 
     def get_track_info(self):
         return {
@@ -105,74 +376,65 @@ class PlayQueue:
         }
 
     def reset(self):
-        self.played = []
-        self.previous = []
         self.position = 0
+        if self.shuffle and self.get_length():
+            # start over with a fresh permutation, next_pos needs one while shuffle is on
+            self.shuffle_order(self.position)
+        else:
+            self.order = array('l')
+            self.order_index = array('l')
+            self.order_pos = 0
 
     def get_track(self):
         self.current_key = self.get_rating_key()
-        if self.current_key not in self.played:
-            self.played.append(self.current_key)
-        if len(self.previous) > 0 and self.previous[-1] != self.current_key:
-            self.previous.append(self.current_key)
-        elif len(self.previous) == 0:
-            self.previous.append(self.current_key)
+        self.current_item_id = self.get_pq_item_id()
         return self.get_url()
 
-    def get_url(self):
-        tracks = self.get_track_list()
-        return tracks[self.position]['Media']['Part']['@key']
+    def get_url(self, position=None):
+        if position is None:
+            position = self.position
+        return self.tracks[position].url
 
-    def get_thumb(self):
-        tracks = self.get_track_list()
-        return tracks[self.position]['@thumb']
+    def get_thumb(self, position=None):
+        if position is None:
+            position = self.position
+        return self.tracks[position].thumb
 
     def get_pq_id(self):
-        return self.dct['MediaContainer']['@playQueueID']
+        return self.pq_id
 
     def get_pq_version(self):
-        return self.dct['MediaContainer']['@playQueueVersion']
-
-    def get_selected_item_off(self):
-        return int(self.dct['MediaContainer']['@playQueueSelectedItemOffset'])
+        return self.pq_version
 
     def get_rating_key(self, position=None):
-        tracks = self.get_track_list()
-        if position:
-            return tracks[position]['@ratingKey']
-        else:
-            return tracks[self.position]['@ratingKey']
+        if position is None:
+            position = self.position
+        return self.tracks[position].rating_key
 
     def get_key(self):
-        tracks = self.get_track_list()
-        return tracks[self.position]['@key']
+        return self.tracks[self.position].key
 
     def get_duration(self):
-        tracks = self.get_track_list()
-        return tracks[self.position]['@duration']
+        return self.tracks[self.position].duration
 
     def get_pq_item_id(self):
-        tracks = self.get_track_list()
-        return tracks[self.position]['@playQueueItemID']
+        return self.tracks[self.position].pq_item_id
 
     def get_length(self):
-        return int(self.dct['MediaContainer']['@size'])
+        return len(self.tracks) if self.tracks is not None else 0
 
     def get_position(self, rating_key):
-        for i, track in enumerate(self.get_track_list()):
-            if track['@ratingKey'] == rating_key:
-                return i
-        self.log.error('Could not find track position: ' + rating_key)
-        self.log.error('Current play queue: ' + str(self))
-
-    def get_track_list(self):
-        if int(self.dct['MediaContainer']['@playQueueTotalCount']) > 1:
-            return self.dct['MediaContainer']['Track']
-        else:
-            return [self.dct['MediaContainer']['Track']]
+        try:
+            return self.rating_key_pos[rating_key]
+        except KeyError:
+            self.log.error('Could not find track position: ' + str(rating_key))
+            self.log.debug('Current play queue: %s', self)
+
+    def get_current_item_id(self):
+        return self.current_item_id
 
     def __str__(self):
-        s = '\n'
-        for pos, track in enumerate(self.get_track_list()):
-            s += str(pos) + ': ' + track['@title'] + ' [' + track['@ratingKey'] + ']\n'
-        return s[:-1]
+        if self.tracks is None:
+            return ''
+        return '\n' + '\n'.join(str(pos) + ': ' + (track.title + ' [' + track.rating_key + ']' if track else '-')
+                                for pos, track in enumerate(self.tracks))
@@ -1,7 +1,8 @@
 import socket
+import selectors
 import threading
 from logging import getLogger
-from time import sleep
+from time import monotonic
 from .const import GDM_HEADER, GDM_DATA, GDM_MULTICAST_PORT, GDM_MULTICAST_ADDR
 
 
@@ -11,17 +12,23 @@ class PlexGdm:
         self.client_group = (GDM_MULTICAST_ADDR, GDM_MULTICAST_PORT)
         self.port = config.gdm_port
         self.socket = None
+        # socket pair to wake up the loop on stop
+        self.wakeup = None
         self.thread = None
         self.running = False
         self.log = getLogger('PlexGdm')
         self.client_data = GDM_DATA.format(config.client_id, config.title, config.companion_port,
                                            config.product, config.version)
+        # messages never change, encode them once
+        self.hello_msg = ('HELLO {}\r\n{}'.format(GDM_HEADER, self.client_data)).encode()
+        self.bye_msg = ('BYE {}\r\n{}'.format(GDM_HEADER, self.client_data)).encode()
+        self.reply_msg = ('HTTP/1.0 200 OK\r\n' + self.client_data).encode()
 
     def hello(self):
-        return ('HELLO {}\r\n{}'.format(GDM_HEADER, self.client_data)).encode()
+        return self.hello_msg
 
     def bye(self):
-        return ('BYE {}\r\n{}'.format(GDM_HEADER, self.client_data)).encode()
+        return self.bye_msg
 
     def register(self):
         try:
@@ -45,6 +52,7 @@ class PlexGdm:
             self.socket.bind(('0.0.0.0', self.port))
         except Exception as e:
             self.log.error('Unable to bind to port: ' + str(e))
+            self.socket.close()
             return False
 
         self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
@@ -53,29 +61,44 @@ class PlexGdm:
         self.socket.setblocking(False)
         return True
 
+    def drain(self):
+        # answer every pending datagram right away, a burst of discovery requests is handled in one go
+        while True:
+            try:
+                data, addr = self.socket.recvfrom(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.log.error('Unable to receive UDP packet: ' + str(e))
+                return
+            self.log.debug('Received UDP packet from {} containing {}'.format(addr, data.strip()))
+            if b'M-SEARCH * HTTP/1.' in data and addr[0] != '127.0.0.1':
+                self.log.info('Detected client discovery request from ' + str(addr))
+                self.log.debug('Send registration data HTTP/1.0 200 OK')
+                try:
+                    self.socket.sendto(self.reply_msg, addr)
+                except Exception as e:
+                    self.log.error('Unable to send client update message: ' + str(e))
+
     def update_loop(self):
         if not self.initialize():
             return
 
         # Send initial client registration
         self.register()
+        next_hello = monotonic() + self.config.gdm_interval
 
-        # Now, listen for client discovery requests and respond.
-        while self.running:
-            try:
-                data, addr = self.socket.recvfrom(1024)
-                self.log.debug('Received UDP packet from {} containing {}'.format(addr, data.strip()))
-            except socket.error:
-                pass
-            else:
-                if 'M-SEARCH * HTTP/1.' in data.decode() and addr[0] != '127.0.0.1':
-                    self.log.info('Detected client discovery request from ' + str(addr))
-                    self.log.debug('Send registration data HTTP/1.0 200 OK')
-                    try:
-                        self.socket.sendto(('HTTP/1.0 200 OK\r\n' + self.client_data).encode(), addr)
-                    except Exception as e:
-                        self.log.error('Unable to send client update message: ' + str(e))
-            sleep(self.config.gdm_interval)
+        # Now, sleep until a client discovery request arrives or the next announcement is due.
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.socket, selectors.EVENT_READ)
+            selector.register(self.wakeup[0], selectors.EVENT_READ)
+            while self.running:
+                for key, _ in selector.select(max(0.0, next_hello - monotonic())):
+                    if key.fileobj is self.socket:
+                        self.drain()
+                if monotonic() >= next_hello:
+                    self.register()
+                    next_hello = monotonic() + self.config.gdm_interval
 
         # Stopping
         self.log.info('Update loop stopped')
@@ -85,13 +108,18 @@ class PlexGdm:
             self.socket.sendto(data, self.client_group)
         except Exception as e:
             self.log.error('Unable to send client update message: ' + str(e))
+        self.socket.close()
 
     def stop(self):
         if self.running:
             self.log.info('Registration shutting down')
             self.running = False
+            self.wakeup[1].send(b'\0')
             self.thread.join()
             del self.thread
+            for sock in self.wakeup:
+                sock.close()
+            self.wakeup = None
         else:
             self.log.info('Registration not running')
 
@@ -99,6 +127,7 @@ class PlexGdm:
         if not self.running:
             self.log.info('Registration starting up')
             self.running = True
+            self.wakeup = socket.socketpair()
             self.thread = threading.Thread(target=self.update_loop, daemon=True)
             self.thread.start()
         else:
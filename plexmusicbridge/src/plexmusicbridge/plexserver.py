@@ -1,10 +1,114 @@
 import requests
 import xmltodict
 import socket
+from requests.adapters import HTTPAdapter
+from xml.etree.ElementTree import XMLPullParser
+from ipaddress import ip_address
+from threading import Lock, Event, Thread
+from logging import getLogger
+from time import monotonic
+from .metrics import metrics
+
+STREAM_CHUNK_SIZE = 16384
+POOL_SIZE = 4
+# connect and read timeout of PMS requests in seconds
+TIMEOUT = (3.05, 10)
+# DNS cache: lifetime of resolved and failed lookups, refresh ahead of expiry and wait time of a cold lookup
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 30
+DNS_REFRESH_AFTER = 0.8
+DNS_COLD_WAIT = 2
+
+
+class HostResolver:
+    """
+    Caches host name lookups, stale entries are served while they are refreshed in the background
+    """
+    def __init__(self):
+        self.log = getLogger('HostResolver')
+        self.lock = Lock()
+        # host -> (address or None, refresh at, expires at)
+        self.entries = {}
+        # host -> event of an in flight lookup
+        self.pending = {}
+
+    @staticmethod
+    def is_ip(host):
+        try:
+            ip_address(host)
+            return True
+        except ValueError:
+            return False
+
+    def prefetch(self, host):
+        if host and not self.is_ip(host):
+            with self.lock:
+                entry = self.entries.get(host)
+                if entry is None or monotonic() >= entry[1]:
+                    self.start_lookup(host)
+
+    def resolve(self, host):
+        # returns the cached address or None if the host can not be resolved (yet)
+        if self.is_ip(host):
+            return host
+        with self.lock:
+            entry = self.entries.get(host)
+            now = monotonic()
+            if entry is not None:
+                address, refresh_at, expires_at = entry
+                if now >= refresh_at:
+                    self.start_lookup(host)
+                if address is not None or now < expires_at:
+                    return address
+            pending = self.start_lookup(host)
+        # nothing cached yet, only the very first lookup of a host is waited for (bounded)
+        pending.wait(DNS_COLD_WAIT)
+        with self.lock:
+            entry = self.entries.get(host)
+        return entry[0] if entry else None
+
+    def start_lookup(self, host):
+        # must be called with lock acquired
+        pending = self.pending.get(host)
+        if pending is None:
+            pending = self.pending[host] = Event()
+            Thread(target=self.lookup, args=(host, pending), daemon=True).start()
+        return pending
+
+    def lookup(self, host, pending):
+        start = monotonic()
+        try:
+            address = socket.gethostbyname(host)
+            ttl = DNS_TTL
+        except OSError as e:
+            self.log.error('Could not resolve %s: %s', host, e)
+            address = None
+            ttl = DNS_NEGATIVE_TTL
+        now = monotonic()
+        metrics.record('dns.lookup', now - start)
+        with self.lock:
+            previous = self.entries.get(host)
+            if address is None and previous is not None and previous[0] is not None and now < previous[2]:
+                # keep serving the last known address until it expires
+                address = previous[0]
+            self.entries[host] = (address, now + ttl * DNS_REFRESH_AFTER, now + ttl)
+            del self.pending[host]
+        pending.set()
+        self.log.debug('Resolved %s to %s', host, address)
+
+
+resolver = HostResolver()
 
 
 class PlexServer:
     def __init__(self):
+        self.log = getLogger('PlexServer')
+        # persistent connections for all PMS requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({'Accept': '*/*', 'Accept-Encoding': 'gzip, deflate', 'Connection': 'keep-alive'})
         self.protocol = ''
         self.address = ''
         self.port = ''
@@ -18,7 +122,7 @@ class PlexServer:
             protocol = self.protocol
 
         if rewrite_host:
-            address = socket.gethostbyname(self.address)
+            address = resolver.resolve(self.address) or self.address
         else:
             address = self.address
 
@@ -46,6 +150,7 @@ class PlexServer:
             self.protocol = opt['protocol']
         if opt.get('address'):
             self.address = opt['address']
+            resolver.prefetch(self.address)
         if opt.get('port'):
             self.port = str(opt['port'])
         elif self.protocol and not self.port:
@@ -55,9 +160,84 @@ class PlexServer:
         if opt.get('machineIdentifier'):
             self.machine_id = opt['machineIdentifier']
 
-    def get_queue(self, container_key):
+    def request(self, resource, params=None, token=True, stream=False):
         if not self.protocol or not self.address:
             raise ValueError('Missing Plex server connection data (protocol/address)')
-        url = self.build_url(container_key)
-        resp = requests.get(url, headers={'Accept': '*/*', 'Content-Type': 'application/json'})
+        url = self.build_url(resource, token)
+        start = monotonic()
+        resp = self.session.get(url, params=params, headers={'Content-Type': 'application/json'}, timeout=TIMEOUT,
+                                stream=stream)
+        elapsed = monotonic() - start
+        metrics.record('pms.request', elapsed)
+        self.log.debug('PMS request %s took %.1f ms', resource, elapsed * 1000)
+        return resp
+
+    def get_queue(self, container_key, window=None, center=None):
+        params = None
+        if window:
+            # only fetch the items around the given play queue item
+            params = {'window': window, 'center': center, 'includeBefore': 1, 'includeAfter': 1}
+        resp = self.request(container_key, params)
         return xmltodict.parse(resp.content, 'utf-8')
+
+    def send_timeline(self, params):
+        # token is part of the timeline parameters
+        self.request('/:/timeline', params, token=False).close()
+
+    def close(self):
+        self.session.close()
+
+    def stream_queue(self, container_key):
+        # send the request now and parse the body lazily while iterating the returned generator
+        resp = self.request(container_key, stream=True)
+        if resp.status_code != 200:
+            resp.close()
+            raise ValueError('PMS returned HTTP {} for {}'.format(resp.status_code, container_key))
+        return self.parse_queue(resp)
+
+    @staticmethod
+    def parse_queue(resp):
+        # yields the MediaContainer attributes followed by each Track element as soon as it is complete
+        parser = XMLPullParser(events=('start', 'end'))
+        container = None
+        try:
+            for chunk in resp.iter_content(STREAM_CHUNK_SIZE):
+                parser.feed(chunk)
+                for event, elem in parser.read_events():
+                    if event == 'start' and elem.tag == 'MediaContainer':
+                        container = elem
+                        yield elem.tag, elem.attrib
+                    elif event == 'end' and elem.tag == 'Track':
+                        yield elem.tag, elem
+                        # drop parsed tracks to keep memory flat
+                        if container is not None:
+                            container.remove(elem)
+            parser.close()
+        finally:
+            resp.close()
+
+
+class PlexServerRegistry:
+    """
+    One PlexServer per machineIdentifier, each with its own connection pool and connection data
+    """
+    def __init__(self):
+        self.log = getLogger('PlexServerRegistry')
+        self.servers = {}
+
+    def update(self, opt):
+        # returns the server the command belongs to, None if it does not carry any server data
+        machine_id = opt.get('machineIdentifier')
+        if not machine_id and not opt.get('address'):
+            return None
+        machine_id = machine_id or ''
+        server = self.servers.get(machine_id)
+        if server is None:
+            self.log.info('Add Plex server: %s', machine_id or opt.get('address'))
+            server = self.servers[machine_id] = PlexServer()
+        server.update(opt)
+        return server
+
+    def close(self):
+        for server in self.servers.values():
+            server.close()
@@ -1,22 +1,57 @@
 from logging import getLogger
 from threading import Thread, Lock, Event
-from requests import post, get
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from time import sleep, monotonic
 from .const import pms_header, companion_header, TIMELINE_STOPPED, TIMELINE_PLAYING
+from .metrics import metrics
+
+# number of parallel subscriber updates and time a single update may take in seconds
+SEND_WORKERS = 8
+SEND_DEADLINE = 2
+
+
+class Timeline:
+    """
+    Timeline message rendered once and shared by all clients, only the command id differs per client
+    """
+    __slots__ = ('prefix', 'suffix', 'playing', 'volume')
+
+    def __init__(self, xml, playing, volume=None):
+        prefix, suffix = xml.split('{command_id}', 1)
+        self.prefix = prefix.encode('utf-8')
+        self.suffix = suffix.encode('utf-8')
+        self.playing = playing
+        self.volume = volume
+
+    def render(self, command_id):
+        return self.prefix + str(command_id).encode() + self.suffix
 
 
 class SubscriptionManager:
     def __init__(self, config, play_mgr):
         self.log = getLogger('SubscriptionManager')
         self.sub_lock = Lock()
+        # last rendered timeline, reused within the same timeline id and time bucket
+        self.msg_lock = Lock()
+        self.msg_key = None
+        self.timeline = None
         self.subscribers = {}
         self.run = Event()
         self.config = config
         self.play_mgr = play_mgr
         self.is_playing = False
         self.last_params = {}
+        self.last_params_time = 0
+        self.pms_timeline_id = None
+        self.pms_last_sent = 0
         self.stop_server_notification = True    # signal stop once
         self.stop_send_to_web = True            # signal stop once
+        self.send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='Subscriber')
+        # PMS reports have their own worker, so a slow server and slow controllers do not hold back each other
+        self.pms_lock = Lock()
+        self.pms_busy = False
+        self.pms_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='PMSReport')
         self.notify_thread = Thread(target=self.notify_run, daemon=True)
         self.notify_thread.start()
 
@@ -28,17 +63,26 @@ class SubscriptionManager:
         return s[:-1]
 
     def msg(self):
+        key = (self.play_mgr.get_timeline_id(), int(monotonic() / float(self.config.notify_interval)))
+        with self.msg_lock:
+            if key != self.msg_key:
+                self.timeline = self.render()
+                self.msg_key = key
+            timeline = self.timeline
+        self.is_playing = timeline.playing
+        if timeline.playing:
+            self.stop_send_to_web = False
+        return timeline
+
+    def render(self):
         state = self.play_mgr.get_state_dct()
         if state:
             state.update({'itemType': 'music'})
             state_str = self.dct_to_str(state)
-            xml = TIMELINE_PLAYING.format(parameters=state_str, command_id='{command_id}')
-            self.is_playing = True
-            self.stop_send_to_web = False
+            xml = TIMELINE_PLAYING.replace('{parameters}', state_str)
+            return Timeline(xml, True, state.get('volume'))
         else:
-            xml = TIMELINE_STOPPED
-            self.is_playing = False
-        return xml
+            return Timeline(TIMELINE_STOPPED, False)
 
     def update_command_id(self, uuid, command_id):
         with self.sub_lock:
@@ -48,6 +92,8 @@ class SubscriptionManager:
     def stop(self):
         self.run.set()
         self.notify_thread.join()
+        self.send_pool.shutdown(wait=False, cancel_futures=True)
+        self.pms_pool.shutdown(wait=False, cancel_futures=True)
 
     def notify_run(self):
         while not self.run.is_set():
@@ -55,14 +101,40 @@ class SubscriptionManager:
             sleep(self.config.notify_interval)
 
     def notify(self):
+        # a report that is still running skips this tick, state changes are picked up by the next one
+        with self.pms_lock:
+            submit = not self.pms_busy
+            self.pms_busy = True
+        if submit:
+            self.pms_pool.submit(self.report_server)
         with self.sub_lock:
+            subscribers = list(self.subscribers.values())
+        if subscribers:
+            msg = self.msg()
+            for subscriber in subscribers:
+                # a subscriber that is still busy with the last update skips this one
+                if subscriber.start_update():
+                    self.send_pool.submit(subscriber.send_update, msg)
+                else:
+                    self.log.debug('Subscriber %s still busy, skip update', subscriber.host)
+
+    def report_server(self):
+        try:
             self.notify_server()
-            if self.subscribers:
-                msg = self.msg()
-                for subscriber in list(self.subscribers.values()):
-                    subscriber.send_update(msg)
+        except Exception as e:
+            self.log.error('Could not report to PMS: ' + str(e))
+        finally:
+            with self.pms_lock:
+                self.pms_busy = False
 
     def notify_server(self):
+        # report state changes immediately, otherwise only send a heartbeat every pms_interval
+        timeline_id = self.play_mgr.get_timeline_id()
+        now = monotonic()
+        if timeline_id == self.pms_timeline_id and now - self.pms_last_sent < self.config.pms_interval:
+            return
+        self.pms_timeline_id = timeline_id
+        self.pms_last_sent = now
         params = self.play_mgr.get_pms_state()
         if params:
             params.update(pms_header(self.config))
@@ -70,31 +142,58 @@ class SubscriptionManager:
                 if not self.stop_server_notification:
                     self.log.info('Send stop notification to PMS')
                     self.stop_server_notification = True
-                    self.last_params['state'] = 'stopped'
-                    self.send_pms_notification(self.last_params)
+                    self.send_pms_notification(self.final_params(now))
             else:
+                if self.last_params.get('playQueueItemID') not in (None, params['playQueueItemID']) \
+                        and not self.stop_server_notification:
+                    # close the previous track with its final position so it gets scrobbled
+                    self.send_pms_notification(self.final_params(now))
                 self.stop_server_notification = False
                 self.send_pms_notification(params)
                 self.last_params = params
+                self.last_params_time = now
+
+    def final_params(self, now):
+        # last reported state as stopped, with the time extrapolated since the last report
+        params = dict(self.last_params)
+        if params.get('state') == 'playing':
+            elapsed = int(params['time']) + int((now - self.last_params_time) * 1000)
+            params['time'] = min(elapsed, int(params['duration']))
+        params['state'] = 'stopped'
+        return params
 
     def send_pms_notification(self, params):
-        url = self.play_mgr.get_current_pms_timeline()
-        get(url, params)
-        self.log.debug('Send PMS notification: %s to %s', params, url)
+        try:
+            self.play_mgr.send_pms_timeline(params)
+        except Exception as e:
+            self.log.error('Could not send PMS notification: ' + str(e))
+        else:
+            self.log.debug('Send PMS notification: %s', params)
 
     def add_subscriber(self, protocol, host, port, uuid, command_id):
         subscriber = Subscriber(protocol, host, port, uuid, command_id, self)
         with self.sub_lock:
+            previous = self.subscribers.get(subscriber.uuid)
+            if previous is not None:
+                previous.retire()
             self.subscribers[subscriber.uuid] = subscriber
             self.log.debug('Add or update subscriber: %s', host)
         return subscriber
 
-    def remove_subscriber(self, uuid):
-        # only called from notify() which already acquired the lock
-        for subscriber in list(self.subscribers.values()):
-            if subscriber.uuid == uuid or subscriber.host == uuid:
-                self.log.debug('Remove subscriber: %s', subscriber.host)
-                del self.subscribers[subscriber.uuid]
+    def remove_subscriber(self, uuid, subscriber=None):
+        # with a subscriber given, it is only removed if it was not replaced by a new subscription in the meantime
+        with self.sub_lock:
+            if subscriber is not None:
+                if self.subscribers.get(subscriber.uuid) is subscriber:
+                    self.log.debug('Remove subscriber: %s', subscriber.host)
+                    del self.subscribers[subscriber.uuid]
+                    subscriber.retire()
+                return
+            for subscriber in list(self.subscribers.values()):
+                if subscriber.uuid == uuid or subscriber.host == uuid:
+                    self.log.debug('Remove subscriber: %s', subscriber.host)
+                    del self.subscribers[subscriber.uuid]
+                    subscriber.retire()
 
 
 class Subscriber:
@@ -106,20 +205,85 @@ class Subscriber:
         self.uuid = uuid or host
         self.command_id = int(command_id) or 0
         self.sub_mgr = sub_mgr
+        self.busy_lock = Lock()
+        self.busy = False
+        # set once the subscriber was replaced or removed, its connection is closed after the running update
+        self.retired = False
+        # keep-alive connection to the controller, only used by one update at a time
+        self.conn = None
+        self.requests = 0
+        self.connects = 0
 
     def __eq__(self, other):
         return self.uuid == other.uuid
 
-    def send_update(self, msg):
-        msg = msg.format(command_id=self.command_id)
-        url = '%s://%s:%s/:/timeline' % (self.protocol, self.host, self.port)
-        try:
-            response = post(url, msg, headers=companion_header(self.sub_mgr.config), timeout=2)
-            self.log.debug('Send update to subscriber: %s to %s', msg, self.host)
-        except Exception as e:
-            self.log.error('Could not send update to subscriber: ' + str(e))
-            self.sub_mgr.remove_subscriber(self.uuid)
+    def start_update(self):
+        with self.busy_lock:
+            if self.busy or self.retired:
+                return False
+            self.busy = True
+            return True
+
+    def connect(self):
+        if self.protocol == 'https':
+            self.conn = HTTPSConnection(self.host, int(self.port), timeout=SEND_DEADLINE)
         else:
-            if response.status_code in (False, None, 401):
-                self.log.error('Could not send update to subscriber, response code: ' + str(response.status_code))
-                self.sub_mgr.remove_subscriber(self.uuid)
+            self.conn = HTTPConnection(self.host, int(self.port), timeout=SEND_DEADLINE)
+        self.connects += 1
+        metrics.increment('subscriber.connects')
+
+    def close(self):
+        # only called by the thread that owns the running update
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            conn.close()
+
+    def retire(self):
+        # the connection must not be closed under a running update, the update closes it when done
+        with self.busy_lock:
+            self.retired = True
+            if self.busy:
+                return
+        self.close()
+
+    def post(self, body):
+        # send on the open connection, reconnect once if the controller closed it in the meantime
+        while True:
+            reused = self.conn is not None
+            if not reused:
+                self.connect()
+            try:
+                self.conn.request('POST', '/:/timeline', body, companion_header(self.sub_mgr.config))
+                response = self.conn.getresponse()
+                response.read()
+            except (HTTPException, OSError):
+                self.close()
+                if reused:
+                    continue
+                raise
+            if response.will_close:
+                self.close()
+            self.requests += 1
+            metrics.increment('subscriber.requests')
+            return response.status
+
+    def send_update(self, timeline):
+        try:
+            msg = timeline.render(self.command_id)
+            try:
+                status = self.post(msg)
+                self.log.debug('Send update to subscriber: %s to %s (%s connections for %s updates)',
+                               msg, self.host, self.connects, self.requests)
+            except Exception as e:
+                self.log.error('Could not send update to subscriber: ' + str(e))
+                self.sub_mgr.remove_subscriber(self.uuid, self)
+            else:
+                if status == 401:
+                    self.log.error('Could not send update to subscriber, response code: ' + str(status))
+                    self.sub_mgr.remove_subscriber(self.uuid, self)
+        finally:
+            with self.busy_lock:
+                self.busy = False
+                retired = self.retired
+            if retired:
+                self.close()
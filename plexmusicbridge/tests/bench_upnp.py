@@ -0,0 +1,107 @@
+"""
+Encode and parse cost of SOAP actions, cached byte templates against the former string building and xmltodict path.
+Run with: python tests/bench_upnp.py
+"""
+import timeit
+import xmltodict
+from plexmusicbridge.player.upnp import ActionTemplate, AV_URN, REND_URN, META_DATA_FMT, meta_data
+
+NUMBER = 20000
+
+PAYLOAD_FMT = '<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
+              's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:{action} xmlns:u="{urn}">' \
+              '{fields}</u:{action}></s:Body></s:Envelope>'
+
+THUMB = 'http://192.168.10.9:32005/art/45077'
+TRACK = 'http://192.168.10.2:32400/library/parts/45077/1690000000/file.flac?X-Plex-Token=abcdef'
+
+# responses recorded from an Azur 851N
+POSITION_INFO = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope ' \
+                b'xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
+                b's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>' \
+                b'<u:GetPositionInfoResponse xmlns:u="urn:schemas-upnp-org:service:AVTransport:1"><Track>1</Track>' \
+                b'<TrackDuration>0:05:19</TrackDuration><TrackMetaData>&lt;DIDL-Lite ' \
+                b'xmlns=&quot;urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/&quot; ' \
+                b'xmlns:dc=&quot;http://purl.org/dc/elements/1.1/&quot; ' \
+                b'xmlns:upnp=&quot;urn:schemas-upnp-org:metadata-1-0/upnp/&quot;&gt;&lt;item id=&quot;1&quot; ' \
+                b'parentID=&quot;0&quot; restricted=&quot;1&quot;&gt;&lt;dc:title&gt;Keeping The Faith' \
+                b'&lt;/dc:title&gt;&lt;upnp:class&gt;object.item.audioItem.musicTrack&lt;/upnp:class&gt;' \
+                b'&lt;upnp:albumArtURI&gt;http://192.168.10.9:32005/art/45077&lt;/upnp:albumArtURI&gt;' \
+                b'&lt;/item&gt;&lt;/DIDL-Lite&gt;</TrackMetaData>' \
+                b'<TrackURI>http://192.168.10.2:32400/library/parts/45077/1690000000/file.flac?X-Plex-Token=abcdef' \
+                b'</TrackURI><RelTime>0:01:42</RelTime><AbsTime>NOT_IMPLEMENTED</AbsTime>' \
+                b'<RelCount>2147483647</RelCount><AbsCount>2147483647</AbsCount></u:GetPositionInfoResponse>' \
+                b'</s:Body></s:Envelope>'
+VOLUME = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
+         b's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>' \
+         b'<u:GetVolumeResponse xmlns:u="urn:schemas-upnp-org:service:RenderingControl:1">' \
+         b'<CurrentVolume>6</CurrentVolume></u:GetVolumeResponse></s:Body></s:Envelope>'
+TRANSPORT_INFO = b'<?xml version="1.0" encoding="utf-8"?><s:Envelope ' \
+                 b'xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" ' \
+                 b's:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>' \
+                 b'<u:GetTransportInfoResponse xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">' \
+                 b'<CurrentTransportState>PLAYING</CurrentTransportState>' \
+                 b'<CurrentTransportStatus>OK</CurrentTransportStatus><CurrentSpeed>1</CurrentSpeed>' \
+                 b'</u:GetTransportInfoResponse></s:Body></s:Envelope>'
+
+
+def old_payload(action, data, urn):
+    fields = ''
+    for item in data:
+        for tag, value in item.items():
+            fields += '<{tag}>{value}</{tag}>'.format(tag=tag, value=value)
+    return PAYLOAD_FMT.format(action=action, urn=urn, fields=fields).encode()
+
+
+def unescape_xml(xml):
+    return xml.decode().replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+
+
+def old_parse(data, action, result):
+    response = xmltodict.parse(unescape_xml(data))
+    return response['s:Envelope']['s:Body']['u:' + action + 'Response'][result]
+
+
+def compare(name, old, new):
+    old_time = timeit.timeit(old, number=NUMBER) / NUMBER * 1e6
+    new_time = timeit.timeit(new, number=NUMBER) / NUMBER * 1e6
+    print('{:<28} old {:8.2f} us   new {:8.2f} us   {:6.1f}x'.format(name, old_time, new_time, old_time / new_time))
+
+
+def main():
+    set_uri = ActionTemplate(AV_URN, 'SetAVTransportURI', ('InstanceID', 'CurrentURI', 'CurrentURIMetaData'), ())
+    seek = ActionTemplate(AV_URN, 'Seek', ('InstanceID', 'Unit', 'Target'), ())
+    position = ActionTemplate(AV_URN, 'GetPositionInfo', ('InstanceID',), ('RelTime',))
+    volume = ActionTemplate(REND_URN, 'GetVolume', ('InstanceID', 'Channel'), ('CurrentVolume',))
+    transport = ActionTemplate(AV_URN, 'GetTransportInfo', ('InstanceID',), ('CurrentTransportState',))
+
+    # both paths have to produce the same envelopes and values
+    old_set_uri = old_payload('SetAVTransportURI', [{'InstanceID': 0}, {'CurrentURI': TRACK},
+                                                   {'CurrentURIMetaData': META_DATA_FMT.format(THUMB)}], AV_URN)
+    assert set_uri.render((0, TRACK, meta_data(THUMB))) == old_set_uri
+    assert position.parse(POSITION_INFO)['RelTime'] == old_parse(POSITION_INFO, 'GetPositionInfo', 'RelTime')
+    assert volume.parse(VOLUME)['CurrentVolume'] == old_parse(VOLUME, 'GetVolume', 'CurrentVolume')
+    assert transport.parse(TRANSPORT_INFO)['CurrentTransportState'] == \
+        old_parse(TRANSPORT_INFO, 'GetTransportInfo', 'CurrentTransportState')
+
+    print('{} iterations each'.format(NUMBER))
+    compare('encode SetAVTransportURI',
+            lambda: old_payload('SetAVTransportURI', [{'InstanceID': 0}, {'CurrentURI': TRACK},
+                                                      {'CurrentURIMetaData': META_DATA_FMT.format(THUMB)}], AV_URN),
+            lambda: set_uri.render((0, TRACK, meta_data(THUMB))))
+    compare('encode Seek',
+            lambda: old_payload('Seek', [{'InstanceID': 0}, {'Unit': 'REL_TIME'}, {'Target': '0:01:42'}], AV_URN),
+            lambda: seek.render((0, 'REL_TIME', '0:01:42')))
+    compare('parse GetPositionInfo',
+            lambda: old_parse(POSITION_INFO, 'GetPositionInfo', 'RelTime'),
+            lambda: position.parse(POSITION_INFO))
+    compare('parse GetVolume',
+            lambda: old_parse(VOLUME, 'GetVolume', 'CurrentVolume'),
+            lambda: volume.parse(VOLUME))
+    compare('parse GetTransportInfo',
+            lambda: old_parse(TRANSPORT_INFO, 'GetTransportInfo', 'CurrentTransportState'),
+            lambda: transport.parse(TRANSPORT_INFO))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+from threading import Thread, Event
+from time import sleep, monotonic
+from plexmusicbridge.config import Config
+from plexmusicbridge.playbackmanager import PlaybackManager
+from plexmusicbridge.playqueue import Track
+from plexmusicbridge.player.template import PlayerConfig
+from plexmusicbridge.subscriptionmanager import SubscriptionManager
+
+READERS = 8
+WRITES = 500
+# polls taken while a track change is in flight and seconds each of them may take
+POLLS = 200
+POLL_BOUND = 0.05
+
+
+def make_tracks(queue_id, length):
+    # all fields of a track are derived from its rating key, so a torn snapshot is easy to spot
+    return [Track(str(queue_id * 1000 + i), '/library/metadata/' + str(queue_id * 1000 + i), '/library/parts/' + str(i),
+                  '', str(queue_id * 1000 + i), 'item' + str(queue_id * 1000 + i), '') for i in range(length)]
+
+
+def check(snapshot):
+    if snapshot.track is None:
+        assert snapshot.state == 'stopped'
+        return
+    track = snapshot.track
+    rating_key = track['ratingKey']
+    assert track['key'] == '/library/metadata/' + rating_key
+    assert track['duration'] == rating_key
+    assert track['playQueueItemID'] == 'item' + rating_key
+    # queue id, shuffle, repeat and state are written together with the tracks
+    queue_id = int(rating_key) // 1000
+    assert track['playQueueID'] == str(queue_id)
+    assert snapshot.repeat == queue_id % 3
+    assert snapshot.state == ('playing' if queue_id % 2 else 'stopped')
+
+
+def test_snapshot_consistent_under_concurrent_writes():
+    manager = PlaybackManager(Config('template', PlayerConfig()))
+    errors = []
+    reads = []
+    done = Event()
+
+    def mutate(i):
+        try:
+            with manager.queue_lock:
+                queue = manager.queue
+                queue.set_tracks(make_tracks(i, 1 + i % 7))
+                queue.pq_id = str(i)
+                queue.set_repeat(i % 3)
+                # every fifth write loses the current item like a refresh that removed it
+                queue.position = None if i % 5 == 0 else i % len(queue.tracks)
+            with manager.lock:
+                manager.is_playing = bool(i % 2) and i % 5 != 0
+            manager.publish()
+        except Exception as e:
+            errors.append(e)
+
+    def read():
+        while not done.is_set():
+            try:
+                check(manager.state)
+                reads.append(1)
+            except Exception as e:
+                errors.append(e)
+                return
+            # leave the interpreter to the executor now and then
+            sleep(0.0005)
+
+    readers = [Thread(target=read) for _ in range(READERS)]
+    for reader in readers:
+        reader.start()
+    try:
+        for i in range(1, WRITES):
+            manager.commands.call(mutate, i)
+    finally:
+        done.set()
+        for reader in readers:
+            reader.join()
+        manager.kill()
+    assert not errors, errors[:3]
+    assert len(reads) > READERS
+    assert manager.state.track is not None
+
+
+def test_polls_do_not_wait_for_track_change():
+    config = Config('template', PlayerConfig())
+    manager = PlaybackManager(config)
+    sub_mgr = SubscriptionManager(config, manager)
+    entered = Event()
+    release = Event()
+
+    def play(track_url, thumb_url):
+        # handshake with a device that takes its time to start the track
+        entered.set()
+        release.wait(10)
+        return True
+
+    manager.player.play = play
+    with manager.queue_lock:
+        manager.queue.set_tracks(make_tracks(1, 3))
+        manager.queue.position = 0
+    change = Thread(target=manager.commands.call, args=(manager.play,))
+    change.start()
+    try:
+        assert entered.wait(5)
+        slowest = 0
+        for _ in range(POLLS):
+            start = monotonic()
+            state = manager.get_state_dct()
+            timeline = sub_mgr.msg()
+            slowest = max(slowest, monotonic() - start)
+            assert state['ratingKey'] == '1000'
+            assert timeline.playing
+        # the executor is still inside load_play
+        assert not release.is_set() and change.is_alive()
+        assert slowest < POLL_BOUND, slowest
+    finally:
+        release.set()
+        change.join()
+        sub_mgr.stop()
+        manager.kill()
@@ -0,0 +1,47 @@
+from plexmusicbridge.playqueue import PlayQueue, Track
+
+
+def make_queue(length):
+    queue = PlayQueue()
+    tracks = [Track(str(i), '/library/metadata/' + str(i), '/library/parts/' + str(i), '', '1000', str(100 + i),
+                    'Track ' + str(i)) for i in range(length)]
+    queue.set_tracks(tracks)
+    queue.position = 0
+    return queue
+
+
+def test_shuffle_next_after_reset():
+    queue = make_queue(10)
+    queue.set_shuffle(1)
+    assert queue.next_pos(False)
+    queue.reset()
+    played = [queue.position]
+    while queue.next_pos(False):
+        played.append(queue.position)
+    # every track once, starting at the first one
+    assert played[0] == 0
+    assert sorted(played) == list(range(10))
+
+
+def test_reset_without_shuffle_clears_order():
+    queue = make_queue(3)
+    queue.next_pos(False)
+    queue.reset()
+    assert queue.position == 0
+    assert len(queue.order) == 0
+    assert queue.next_pos(False)
+    assert queue.position == 1
+
+
+def test_no_window_while_streaming():
+    queue = PlayQueue()
+    generation = queue.begin({'playQueueID': '1', 'playQueueVersion': '1', 'playQueueTotalCount': '300',
+                              'playQueueSelectedItemOffset': '199', 'playQueueSelectedItemID': '199'})
+    for i in range(200):
+        assert queue.add_track(generation, Track(str(i), '/library/metadata/' + str(i), '/library/parts/' + str(i),
+                                                 '', '1000', str(i), 'Track ' + str(i)))
+    assert queue.is_loaded()
+    # tracks after the selected one are still arriving, a windowed refresh would abort the stream
+    assert not queue.needs_window(10)
+    queue.finish(generation)
+    assert queue.needs_window(10)